@@ -1,232 +1,159 @@
 import streamlit as st
-import os
-import random
-import calendar
 import io
-import zipfile
+import os
+import re
+import time
+import uuid
 from datetime import date, timedelta
-from docx import Document
+from itertools import islice
+from formengine import (
+    Config, FormArchive, FormNumberStore, JobManager, TemplateCache, template_cache, combine_documents,
+    MergeSource, current_profiler, detect_type, form_documents, plan_forms, plan_merge, render_form_sets, render_forms,
+    reproducible_seed, stream_extract_details, write_zip,
+)
 
 # ==========================================
-# 1. HONG KONG HOLIDAYS DATABASE
+# 1. GENERATION LOGIC
 # ==========================================
-class HKHolidays:
-    """Contains public holiday dates for Hong Kong (2024-2026)."""
-    HOLIDAYS = {
-        # --- 2024 ---
-        date(2024, 1, 1), date(2024, 2, 10), date(2024, 2, 12), date(2024, 2, 13),
-        date(2024, 3, 29), date(2024, 3, 30), date(2024, 4, 1), date(2024, 4, 4),
-        date(2024, 5, 1), date(2024, 5, 15), date(2024, 6, 10), date(2024, 7, 1),
-        date(2024, 9, 18), date(2024, 10, 1), date(2024, 10, 11), date(2024, 12, 25), date(2024, 12, 26),
-        # --- 2025 ---
-        date(2025, 1, 1), date(2025, 1, 29), date(2025, 1, 30), date(2025, 1, 31),
-        date(2025, 4, 4), date(2025, 4, 18), date(2025, 4, 19), date(2025, 4, 21),
-        date(2025, 5, 1), date(2025, 5, 5), date(2025, 5, 31), date(2025, 7, 1),
-        date(2025, 10, 1), date(2025, 10, 7), date(2025, 10, 29), date(2025, 12, 25), date(2025, 12, 26),
-        # --- 2026 (Projected) ---
-        date(2026, 1, 1), date(2026, 2, 17), date(2026, 2, 18), date(2026, 2, 19),
-        date(2026, 4, 3), date(2026, 4, 4), date(2026, 4, 6), date(2026, 5, 1),
-        date(2026, 5, 25), date(2026, 6, 19), date(2026, 7, 1), date(2026, 9, 26),
-        date(2026, 10, 1), date(2026, 10, 19), date(2026, 12, 25), date(2026, 12, 26),
-    }
-
-    @staticmethod
-    def is_holiday(check_date):
-        return check_date in HKHolidays.HOLIDAYS
+def generate_docs_in_memory(template_file, form_data, start_date, end_date, req_type, start_num, engine="splice", workers=1, seed=None, job=None, combined=False, rows=None, numbers=None, archive=None, assignments=None):
+    """Yields (filename, docx bytes) for each form as soon as it is rendered.
 
-# ==========================================
-# 2. CONFIGURATION & UTILS
-# ==========================================
-class Config:
-    VALID_INSP_TYPES = ["RGI", "SAFE", "WSIN", "ENVI"]
-    KEY_MAPPING = {
-        "PI Inspection Form": "location", "Project No": "project_no",
-        "Inspector": "inspector", "Contractor": "contractor",
-        "Form No": "form_no", "Insp Type": "insp_type",
-        "Scheduled": "scheduled", "Deadline": "deadline",
-        "Performed By": "inspector", "Checked By": "checker",
-        "Date": "perform_date",
-    }
-
-class DocUtils:
-    @staticmethod
-    def find_next_real_cell(row_cells, current_index):
-        current_cell = row_cells[current_index]
-        next_index = current_index + 1
-        while next_index < len(row_cells):
-            next_cell = row_cells[next_index]
-            if next_cell._element is not current_cell._element:
-                return next_cell
-            next_index += 1
-        return None
-
-    @staticmethod
-    def safe_update_cell(cell, new_value):
-        if not cell: return
-        if cell.paragraphs:
-            p = cell.paragraphs[0]
-            if p.runs:
-                p.runs[0].text = str(new_value)
-                for run in p.runs[1:]: run.text = ""
-            else:
-                p.add_run(str(new_value))
-        else:
-            cell.text = str(new_value)
-
-class DateEngine:
-    @staticmethod
-    def get_random_weekday(year, month, start_day, end_day):
-        _, last_day_of_month = calendar.monthrange(year, month)
-        actual_start = max(1, start_day)
-        actual_end = min(end_day, last_day_of_month)
-        
-        if actual_start > actual_end: return date(year, month, actual_end)
+    With `combined`, yields (filename, document XML) for `combine_documents`.
+    With mail-merge `rows`, renders one form per row instead of one per
+    scheduled date (the date range is then unused).
+    When run as a background `job`, its total is set once the forms are planned.
+    With `numbers` (see `FormNumberStore.reserver`), form numbers are reserved
+    from the shared sequences, `start_num` being the lowest allowed.
+    With an `archive`, every rendered form is also stored in it (not combined ones).
+    With planned `assignments` (e.g. a selection from the plan), renders exactly those.
+    """
+    # Load template into memory once to check validity
+    with current_profiler().stage("load_template"):
+        try:
+            template_bytes = template_file.getvalue()
+        except:
+            return
 
-        valid_dates = []
-        for day in range(actual_start, actual_end + 1):
-            try:
-                curr_date = date(year, month, day)
-                # Weekday < 5 means Mon(0) to Fri(4)
-                if curr_date.weekday() < 5 and not HKHolidays.is_holiday(curr_date):
-                    valid_dates.append(curr_date)
-            except ValueError: continue
-            
-        if valid_dates: return random.choice(valid_dates)
-        return date(year, month, actual_start)
+        # Resolve label -> cell slots once per template content, shared across sessions
+        template = template_cache.compiled(template_bytes, engine)
 
-# ==========================================
-# 3. EXTRACTION LOGIC
-# ==========================================
-def extract_details_from_doc(doc_obj):
-    extracted = {
-        "location": "", "project_no": "",
-        "inspector": "", "contractor": "", "checker": ""
-    }
-    keys = {
-        "PI Inspection Form": "location", "Location": "location",
-        "Project No": "project_no", "Inspector": "inspector",
-        "Contractor": "contractor", "Checked By": "checker"
-    }
-    
-    for table in doc_obj.tables:
-        for row in table.rows:
-            cells = row.cells
-            for i, cell in enumerate(cells):
-                cell_text = cell.text.strip()
-                for key, field in keys.items():
-                    if key in cell_text:
-                        if key == "Inspector" and "PI Inspection" in cell_text: continue
-                        target = DocUtils.find_next_real_cell(cells, i)
-                        if target and target.text.strip():
-                            extracted[field] = target.text.strip()
-    return extracted
+    if assignments is not None:
+        if job is not None:
+            job.total = len(assignments)
+    elif rows is not None:
+        assignments = plan_merge(rows, form_data, req_type, start_num, numbers) # streamed, total unknown
+    else:
+        assignments = plan_forms(form_data, start_date, end_date, req_type, start_num, seed, numbers)
+        if job is not None:
+            job.total = len(assignments)
+    if combined:
+        yield from form_documents(template, assignments)
+    elif archive is not None:
+        yield from archive.record(assignments, lambda forms: render_forms(template, forms, workers))
+    else:
+        yield from render_forms(template, assignments, workers)
 
-# ==========================================
-# 4. GENERATION LOGIC
-# ==========================================
-def generate_docs_in_memory(template_file, form_data, start_date, end_date, req_type, start_num):
-    # Load template into memory once to check validity
-    try:
-        template_bytes = template_file.getvalue()
-    except:
-        return None
+def generate_multi_in_memory(batches, start_date, end_date, start_num, engine="splice", workers=1, job=None, numbers=None, archive=None, reproducible=False):
+    """Yields ("<project>/<TYPE>/<form>.docx", docx bytes) for several templates in one pass.
 
-    # Calculate Month Range
-    start_m, start_y = start_date.month, start_date.year
-    end_m, end_y = end_date.month, end_date.year
-    
-    generated_files = [] # List of (filename, bio_stream)
-    counter = start_num
-    
-    curr_m, curr_y = start_m, start_y
-    
-    while (curr_y < end_y) or (curr_y == end_y and curr_m <= end_m):
-        # Date Logic
-        dates = []
-        _, last_day = calendar.monthrange(curr_y, curr_m)
-        
-        if req_type == "SAFE":
-            d1 = DateEngine.get_random_weekday(curr_y, curr_m, 1, 7)
-            min_gap = d1 + timedelta(days=14)
-            d2 = DateEngine.get_random_weekday(curr_y, curr_m, min_gap.day, last_day)
-            dates = [d1, d2]
-        else:
-            dates = [DateEngine.get_random_weekday(curr_y, curr_m, 1, last_day)]
-            
-        # Prepare Base Data
-        month_str = f"{curr_m:02d}"
-        base_data = form_data.copy()
-        base_data["scheduled"] = f"01/{month_str}/{curr_y}"
-        base_data["deadline"] = f"{last_day}/{month_str}/{curr_y}"
-        base_data["insp_type"] = req_type
-        
-        # Create Files
-        for perform_dt in dates:
-            date_str = perform_dt.strftime("%d/%m/%Y")
-            form_no = f"IPRJ{req_type}{counter:04d}"
-            
-            final_data = base_data.copy()
-            final_data["form_no"] = form_no
-            final_data["perform_date"] = date_str
-            
-            # Open fresh doc from memory bytes
-            doc = Document(io.BytesIO(template_bytes))
-            
-            # Fill Table
-            for table in doc.tables:
-                for row in table.rows:
-                    cells = row.cells
-                    for i, cell in enumerate(cells):
-                        text = cell.text.strip()
-                        for key, field in Config.KEY_MAPPING.items():
-                            if key in text:
-                                if key == "Inspector" and "PI Inspection" in text: continue
-                                target = DocUtils.find_next_real_cell(cells, i)
-                                if target:
-                                    DocUtils.safe_update_cell(target, final_data.get(field, ""))
-            
-            # Save to memory stream
-            file_stream = io.BytesIO()
-            doc.save(file_stream)
-            file_stream.seek(0)
-            
-            filename = f"{form_no}.docx"
-            generated_files.append((filename, file_stream))
-            
-            counter += 1
-            
-        curr_m += 1
-        if curr_m > 12:
-            curr_m = 1
-            curr_y += 1
-            
-    return generated_files
+    `batches` holds (template file, form data, insp type) triples. Each
+    template is compiled once and every batch planned up front, then all
+    forms render through one worker pool into one output. Templates sharing
+    a project and type continue its numbering instead of repeating it.
+    """
+    counters = {} # (type, project) -> next form number, without a number store
+    def next_numbers(insp_type, project_no, count):
+        first = counters.get((insp_type, project_no), start_num)
+        counters[(insp_type, project_no)] = first + count
+        return first
+
+    form_sets = []
+    for template_file, form_data, req_type in batches:
+        with current_profiler().stage("load_template"):
+            template = template_cache.compiled(template_file.getvalue(), engine)
+        project_no = str(form_data.get("project_no") or "")
+        seed = reproducible_seed(project_no, req_type, start_date, end_date) if reproducible else None
+        planned = plan_forms(form_data, start_date, end_date, req_type, start_num, seed, numbers or next_numbers)
+        project_dir = re.sub(r'[\\/:*?"<>|\x00-\x1f]+', "_", project_no).strip() or "No project" # safe folder name
+        folder = f"{project_dir}/{req_type}"
+        form_sets.append((folder, template, planned))
+    if job is not None:
+        job.total = sum(len(planned) for _, _, planned in form_sets)
+
+    forms = render_form_sets(form_sets, workers)
+    if archive is None:
+        for folder, fname, content in forms:
+            yield f"{folder}/{fname}", content
+        return
+    planned_data = {(folder, fname): data for folder, _, planned in form_sets for fname, data in planned}
+    with archive.writer() as put:
+        for folder, fname, content in forms:
+            put(fname, planned_data[(folder, fname)], content)
+            yield f"{folder}/{fname}", content
+
+def request_key(*parts):
+    # Number-reservation key naming a request by its templates, details and period
+    return "app:" + TemplateCache.digest(repr(parts).encode("utf-8"))
 
 # ==========================================
-# 5. STREAMLIT UI
+# 2. STREAMLIT UI
 # ==========================================
 st.set_page_config(page_title="Insp Form Gen", page_icon="📝")
 
+@st.cache_resource
+def get_job_manager():
+    # One bounded job pool per server process, shared by every session
+    return JobManager()
+
+@st.cache_resource
+def get_number_store():
+    # Form-number sequences shared by every session (and other processes using the same file)
+    return FormNumberStore()
+
+@st.cache_resource
+def get_archive():
+    # Index and blob store of every generated form, so ZIPs can be rebuilt later
+    return FormArchive()
+
+def generation_options():
+    # Numbering, parallelism, archiving and reproducibility widgets, shared by the one- and several-template forms
+    start_num = st.number_input("Starting Form Number", min_value=1, value=1)
+    workers = st.number_input("Parallel Workers", min_value=1, max_value=os.cpu_count() or 1, value=1)
+    reserve_numbers = st.checkbox("Reserve form numbers", value=True,
+                                  help="Take the next free numbers of each type and project, so concurrent users never repeat a number; the starting number is then the lowest allowed")
+    archive_forms = st.checkbox("Archive generated forms",
+                                help="Keep a copy of every form so it can be downloaded again later (not for combined documents); the archive is never pruned")
+    reproducible = st.checkbox("Reproducible output",
+                               help="Derive the dates from the project, type and period, and reserve numbers under a key of the request, so the same request always gives byte-identical files")
+    return start_num, workers, reserve_numbers, archive_forms, reproducible
+
+job_manager = get_job_manager()
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
+
+profile_jobs = st.sidebar.checkbox("Profile generation", help="Record per-stage timings and memory peaks")
+
 st.title("📝 Inspection Form Generator")
 st.markdown("Upload a template, verify details, and generate a ZIP of filled forms.")
 
 # --- STEP 1: UPLOAD ---
 st.subheader("1. Upload Template")
-uploaded_file = st.file_uploader("Upload Word Document (.docx)", type=["docx"])
+uploaded_files = st.file_uploader("Upload Word Document (.docx)", type=["docx"], accept_multiple_files=True,
+                                  help="Upload several templates (e.g. one per inspection type) to generate them all into one ZIP")
+uploaded_file = uploaded_files[0] if len(uploaded_files) == 1 else None
 
 if uploaded_file:
     # Auto-detect type from filename
-    filename_upper = uploaded_file.name.upper()
-    detected_type = "RGI" # Default
-    for t in Config.VALID_INSP_TYPES:
-        if t in filename_upper:
-            detected_type = t
-            break
+    detected_type = detect_type(uploaded_file.name)
             
-    # Extract Data Preview
-    if 'extracted_data' not in st.session_state:
-        doc_preview = Document(uploaded_file)
-        st.session_state['extracted_data'] = extract_details_from_doc(doc_preview)
+    # Extract Data Preview (re-read whenever a different file is uploaded)
+    template_bytes = uploaded_file.getvalue()
+    digest = TemplateCache.digest(template_bytes)
+    if st.session_state.get('template_digest') != digest:
+        st.session_state['template_digest'] = digest
+        st.session_state['extracted_data'] = template_cache.get(
+            (digest, "details"), lambda: stream_extract_details(template_bytes)
+        )
 
     # --- STEP 2: CONFIGURATION ---
     st.divider()
@@ -235,12 +162,15 @@ if uploaded_file:
     col1, col2 = st.columns(2)
     with col1:
         insp_type = st.selectbox("Inspection Type", Config.VALID_INSP_TYPES, index=Config.VALID_INSP_TYPES.index(detected_type) if detected_type in Config.VALID_INSP_TYPES else 0)
-        start_num = st.number_input("Starting Form Number", min_value=1, value=1)
+        combined = st.checkbox("Combine into one document", help="One .docx with a section per form, for printing and archiving")
+        start_num, workers, reserve_numbers, archive_forms, reproducible = generation_options()
         
     with col2:
         # Date Range Picker
         today = date.today()
         d_range = st.date_input("Select Date Range (Start to End)", [today, today + timedelta(days=30)])
+        merge_file = st.file_uploader("Mail-merge rows (optional)", type=["csv", "xlsx"],
+                                      help="One form per row; columns named after form fields override the details below")
     
     st.info("Verify the data extracted from the template below:")
     
@@ -265,37 +195,249 @@ if uploaded_file:
             "checker": new_check
         }
 
-    # --- STEP 3: GENERATE ---
+    # --- STEP 3: PLAN ---
+    # Planning only fixes numbers, dates and values; forms render when previewed or downloaded
     st.divider()
-    if st.button("🚀 Generate Forms", type="primary"):
-        if len(d_range) != 2:
+    st.subheader("3. Plan & Generate")
+    if st.button("📋 Plan Forms", type="primary"):
+        if len(d_range) != 2 and not merge_file:
             st.error("Please select both a Start Date and an End Date.")
         else:
-            with st.spinner("Processing documents..."):
-                start_d, end_d = d_range
-                
-                # Run Generation
-                files_list = generate_docs_in_memory(
-                    uploaded_file, form_data, start_d, end_d, insp_type, int(start_num)
-                )
-                
-                if files_list:
-                    # Create ZIP in memory
-                    zip_buffer = io.BytesIO()
-                    with zipfile.ZipFile(zip_buffer, "w") as zf:
-                        for fname, fcontent in files_list:
-                            zf.writestr(fname, fcontent.getvalue())
-                    
-                    zip_buffer.seek(0)
-                    
-                    st.success(f"Success! Generated {len(files_list)} forms.")
-                    
-                    # Download Button
-                    st.download_button(
-                        label="📥 Download ZIP File",
-                        data=zip_buffer,
-                        file_name=f"Inspection_Forms_{insp_type}.zip",
-                        mime="application/zip"
-                    )
+            start_d, end_d = d_range if len(d_range) == 2 else (None, None)
+            # A reproducible request reserves under its own key, so repeating it gets the same numbers back
+            key = request_key(digest, insp_type, form_data, start_d, end_d,
+                              merge_file and TemplateCache.digest(merge_file.getvalue())) if reproducible else None
+            if merge_file and reserve_numbers and key is None:
+                key = f"app:plan:{uuid.uuid4().hex}" # the merge is planned again as it streams; keep its numbers
+            numbers = get_number_store().reserver(key, int(start_num)) if reserve_numbers else None
+            merge = None
+            try:
+                if merge_file:
+                    # Only the first rows are planned for review; generating streams the whole file
+                    rows = MergeSource(io.BytesIO(merge_file.getvalue()), merge_file.name)
+                    planned = list(islice(plan_merge(rows, dict(form_data), insp_type, int(start_num), numbers),
+                                          Config.MERGE_PREVIEW_ROWS))
+                    label = f"{insp_type} forms from {merge_file.name}"
+                    merge = {"file": merge_file, "form_data": dict(form_data), "start_num": int(start_num),
+                             "key": key if reserve_numbers else None} # numbers repeat under the same key
                 else:
-                    st.error("Failed to generate files.")
\ No newline at end of file
+                    seed = reproducible_seed(form_data["project_no"], insp_type, start_d, end_d) if reproducible else None
+                    planned = plan_forms(dict(form_data), start_d, end_d, insp_type, int(start_num), seed, numbers)
+                    label = f"{insp_type} forms {start_d:%d/%m/%Y} - {end_d:%d/%m/%Y}"
+                st.session_state['plan'] = {"digest": digest, "type": insp_type, "label": label, "forms": planned,
+                                            "merge": merge}
+            except ValueError as e:
+                st.error(f"Could not plan the forms. {e}")
+
+    plan = st.session_state.get('plan')
+    if plan and plan["digest"] == digest:
+        forms = plan["forms"]
+        template = template_cache.compiled(template_bytes, "splice", digest)
+        if plan["merge"] and len(forms) == Config.MERGE_PREVIEW_ROWS:
+            st.caption(f"First {len(forms)} forms planned: {plan['label']}; the remaining rows are planned as they generate")
+        else:
+            st.caption(f"{len(forms)} forms planned: {plan['label']}")
+        picked = st.data_editor(
+            [{"Select": False, "Form No": data["form_no"], "Performed": data.get("perform_date", ""),
+              "Scheduled": data.get("scheduled", ""), "Deadline": data.get("deadline", "")} for _, data in forms],
+            disabled=["Form No", "Performed", "Scheduled", "Deadline"],
+            hide_index=True,
+            key=f"plan_table_{id(forms)}",
+        )
+        selected = [forms[n] for n, row in enumerate(picked) if row["Select"]]
+
+        # Preview and single download render one form, once per choice
+        if forms and st.toggle("👁 Preview a form"):
+            n = st.selectbox("Form", range(len(forms)), format_func=lambda n: forms[n][0])
+            fname, data = forms[n]
+            preview_key = (digest, fname, repr(sorted(data.items())))
+            if st.session_state.get('preview', (None,))[0] != preview_key:
+                st.session_state['preview'] = (preview_key, template.preview(data), template.render(data))
+            _, preview_html, form_bytes = st.session_state['preview']
+            st.download_button(
+                label=f"📄 Download {fname}",
+                data=form_bytes,
+                file_name=fname,
+                mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            )
+            st.markdown(preview_html, unsafe_allow_html=True)
+
+        g1, g2 = st.columns(2)
+        generate_all = g1.button("🚀 Generate All" if plan["merge"] else f"🚀 Generate All ({len(forms)})")
+        generate_selected = g2.button(f"📦 Generate Selected ({len(selected)})", disabled=not selected)
+        if generate_all or generate_selected:
+            chosen = forms if generate_all else selected
+            label = plan["label"] if generate_all else f"{len(chosen)} selected {plan['label']}"
+            if combined:
+                build = lambda documents: combine_documents(template, documents)
+                file_name = f"Inspection_Forms_{plan['type']}.docx"
+            else:
+                build, file_name = write_zip, f"Inspection_Forms_{plan['type']}.zip"
+            archive = get_archive() if archive_forms else None
+            if generate_all and plan["merge"]:
+                # Every merge row, streamed from the file; the preview's reservation key repeats its numbers
+                merge = plan["merge"]
+                numbers = get_number_store().reserver(merge["key"], merge["start_num"]) if merge["key"] else None
+                options = dict(form_data=merge["form_data"], start_num=merge["start_num"], numbers=numbers,
+                               rows=MergeSource(io.BytesIO(merge["file"].getvalue()), merge["file"].name))
+            else:
+                options = dict(form_data=None, start_num=None, assignments=chosen)
+
+            # Run Generation in the background, streaming each form into the output file
+            job_manager.submit(
+                label,
+                file_name,
+                lambda job: generate_docs_in_memory(uploaded_file, start_date=None, end_date=None, req_type=plan["type"], workers=int(workers), job=job, combined=combined, archive=archive, **options),
+                owner=st.session_state['session_id'],
+                profile=profile_jobs,
+                build=build,
+            )
+
+elif uploaded_files:
+    # --- SEVERAL TEMPLATES: one job and one ZIP, with a folder per project and type ---
+    templates = [] # (file, extracted details), each content parsed once per process
+    for template_file in uploaded_files:
+        template_bytes = template_file.getvalue()
+        digest = TemplateCache.digest(template_bytes)
+        templates.append((template_file, template_cache.get((digest, "details"), lambda: stream_extract_details(template_bytes))))
+
+    st.divider()
+    st.subheader("2. Configure Templates")
+    col1, col2 = st.columns(2)
+    with col1:
+        start_num, workers, reserve_numbers, archive_forms, reproducible = generation_options()
+    with col2:
+        today = date.today()
+        d_range = st.date_input("Select Date Range (Start to End)", [today, today + timedelta(days=30)])
+
+    st.info("Verify the type and details of each template below:")
+    detected = [detect_type(f.name) for f, _ in templates] # "UNKNOWN" is left blank for the user to choose
+    rows = st.data_editor(
+        [{"Template": f.name, "Type": t if t in Config.VALID_INSP_TYPES else None, "Location": d.get("location"), "Project No": d.get("project_no"),
+          "Inspector": d.get("inspector"), "Contractor": d.get("contractor"), "Checked By": d.get("checker")}
+         for (f, d), t in zip(templates, detected)],
+        column_config={"Type": st.column_config.SelectboxColumn("Type", options=Config.VALID_INSP_TYPES, required=True)},
+        disabled=["Template"],
+        hide_index=True,
+        key="multi_templates_" + "_".join(TemplateCache.digest(f.getvalue())[:8] for f, _ in templates),
+    )
+
+    st.divider()
+    st.subheader("3. Generate")
+    if st.button(f"🚀 Generate All ({len(templates)} templates)", type="primary"):
+        untyped = [row["Template"] for row in rows if row["Type"] not in Config.VALID_INSP_TYPES]
+        if len(d_range) != 2:
+            st.error("Please select both a Start Date and an End Date.")
+        elif untyped:
+            st.error(f"Please choose an Inspection Type for {', '.join(untyped)}.")
+        else:
+            start_d, end_d = d_range
+            batches = [
+                (f, {"location": row["Location"] or "", "project_no": row["Project No"] or "",
+                     "inspector": row["Inspector"] or "", "contractor": row["Contractor"] or "",
+                     "checker": row["Checked By"] or ""}, row["Type"])
+                for (f, _), row in zip(templates, rows)
+            ]
+            key = request_key(*[(TemplateCache.digest(f.getvalue()), data, req_type) for f, data, req_type in batches],
+                              start_d, end_d) if reproducible else None
+            numbers = get_number_store().reserver(key, int(start_num)) if reserve_numbers else None
+            archive = get_archive() if archive_forms else None
+            types = ", ".join(sorted({row["Type"] for row in rows}))
+
+            # One background job renders every template's forms into a single ZIP
+            job_manager.submit(
+                f"{types} forms from {len(batches)} templates {start_d:%d/%m/%Y} - {end_d:%d/%m/%Y}",
+                "Inspection_Forms_Batch.zip",
+                lambda job: generate_multi_in_memory(batches, start_d, end_d, int(start_num), workers=int(workers), job=job, numbers=numbers, archive=archive, reproducible=reproducible),
+                owner=st.session_state['session_id'],
+                profile=profile_jobs,
+                build=write_zip,
+            )
+
+# --- STEP 4: RESULTS (kept across reruns until they expire) ---
+my_jobs = job_manager.jobs_for(st.session_state['session_id'])
+if my_jobs:
+    st.divider()
+    st.subheader("4. Generation Jobs")
+
+for job in my_jobs:
+    st.markdown(f"**{job.label}** ({job.status})")
+    if not job.finished:
+        st.progress(job.progress, text=f"{job.done} / {job.total or '?'} forms")
+        if st.button("✖ Cancel", key=f"cancel_{job.id}"):
+            job.cancel()
+    elif job.status == "done" and job.result[1]:
+        output_bytes, form_count = job.result
+        st.success(f"Success! Generated {form_count} forms.")
+        
+        # Download Button
+        is_docx = job.file_name.endswith(".docx")
+        st.download_button(
+            label="📥 Download Combined Document" if is_docx else "📥 Download ZIP File",
+            data=output_bytes,
+            file_name=job.file_name,
+            mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document" if is_docx else "application/zip",
+            key=f"download_{job.id}"
+        )
+    elif job.status == "cancelled":
+        st.warning(f"Cancelled after {job.done} forms.")
+    else:
+        st.error(f"Failed to generate files. {job.error or ''}")
+    if job.finished and st.button("Dismiss", key=f"dismiss_{job.id}"):
+        job_manager.discard(job.id)
+        st.rerun()
+
+# --- STEP 5: ARCHIVE (forms from earlier runs, rebuilt without regenerating) ---
+st.divider()
+with st.expander("🗄️ Archived Forms"):
+    a1, a2, a3 = st.columns(3)
+    q_project = a1.text_input("Project No", key="archive_project")
+    q_form = a2.text_input("Form No", key="archive_form_no")
+    q_type = a3.selectbox("Inspection Type", ["Any"] + Config.VALID_INSP_TYPES, key="archive_type")
+    q_range = st.date_input("Perform Date Range", [], key="archive_range")
+    q_start, q_end = q_range if len(q_range) == 2 else (None, None)
+
+    # Queried only on request, not on every rerun while jobs are polled
+    if st.button("🔍 Search Archive"):
+        if not (q_project or q_form or q_type != "Any" or q_start):
+            st.error("Enter at least one filter to search the archive.")
+        else:
+            st.session_state['archive_found'] = get_archive().find(
+                q_project, None if q_type == "Any" else q_type, q_form, q_start, q_end, limit=Config.ARCHIVE_SEARCH_LIMIT
+            )
+    found = st.session_state.get('archive_found')
+    if found is not None:
+        limited = " (search limit reached, narrow the filters)" if len(found) == Config.ARCHIVE_SEARCH_LIMIT else ""
+        st.caption(f"{len(found)} archived forms match{limited}.")
+    if found:
+        st.dataframe(
+            [{"Form No": r["form_no"], "Project": r["project_no"], "Type": r["insp_type"], "Performed": r["perform_date"]}
+             for r in found[:500]],
+            hide_index=True,
+        )
+        if st.button("📦 Build ZIP from Archive"):
+            archive_zip, zip_count = get_archive().build_zip(found)
+            with archive_zip:
+                archive_bytes = archive_zip.read() # Streamlit serves bytes, not the spooled file
+            st.download_button(
+                label=f"📥 Download {zip_count} Archived Forms",
+                data=archive_bytes,
+                file_name="Archived_Inspection_Forms.zip",
+                mime="application/zip",
+            )
+
+# Performance panel for the latest profiled job
+profiled = [job for job in my_jobs if job.finished and job.profiler.enabled]
+if profiled:
+    report = profiled[-1].profiler.report()
+    st.sidebar.subheader("Performance")
+    st.sidebar.caption(f"{profiled[-1].label}: {report['wall_seconds']:.2f}s wall")
+    st.sidebar.table([
+        {"Stage": name, "Calls": s["calls"], "Seconds": f"{s['seconds']:.3f}", "Peak KB": s["peak_kb"]}
+        for name, s in report["stages"].items()
+    ])
+
+# Poll while any job is still working; a widget interaction interrupts the wait
+if any(not job.finished for job in my_jobs):
+    time.sleep(1)
+    st.rerun()
\ No newline at end of file
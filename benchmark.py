@@ -0,0 +1,310 @@
+"""Benchmark harness for the form generation pipeline.
+
+Builds synthetic templates, then times both entry points (the web app's
+generate_docs_in_memory + ZIP, and the CLI's FormGenerator writing to a
+folder) over 1-month, 1-year and 10-year ranges. Every case runs in a
+fresh interpreter so peak RSS belongs to that case alone. Results are
+appended as JSON lines, one per case, so runs can be compared over time.
+
+    python benchmark.py                      # full matrix
+    python benchmark.py --quick --workers 4  # 1-month and 1-year only
+"""
+import os
+import argparse
+import io
+import json
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import date, datetime
+
+try:
+    import resource # Not available on Windows: RSS is then reported as null
+except ImportError:
+    resource = None
+
+# ==========================================
+# 1. CONFIGURATION
+# ==========================================
+class BenchConfig:
+    # Synthetic template shapes: filler tables, share of merged cells,
+    # where the label table sits and how large the embedded image is
+    TEMPLATES = {
+        "small": {"tables": 3, "merge_density": 0.0, "label_position": "first", "image_kb": 0},
+        "merged": {"tables": 25, "merge_density": 0.3, "label_position": "spread", "image_kb": 0},
+        "large": {"tables": 80, "merge_density": 0.15, "label_position": "last", "image_kb": 0},
+        "photos": {"tables": 10, "merge_density": 0.1, "label_position": "first", "image_kb": 8192},
+    }
+
+    RANGES = {
+        "1-month": (date(2025, 1, 1), date(2025, 1, 31)),
+        "1-year": (date(2025, 1, 1), date(2025, 12, 31)),
+        "10-year": (date(2016, 1, 1), date(2025, 12, 31)),
+    }
+
+    ENTRY_POINTS = ["app", "cli"]
+
+    FORM_DATA = {
+        "location": "Site A", "project_no": "P-1234",
+        "inspector": "J. Chan", "contractor": "ABC Ltd", "checker": "K. Wong"
+    }
+
+# ==========================================
+# 2. SYNTHETIC TEMPLATES
+# ==========================================
+class SyntheticTemplate:
+    """Writes .docx templates shaped like real inspection forms."""
+
+    LABELS = [
+        ("PI Inspection Form", "Site A"), ("Project No", "P-1234"), ("Inspector", "J. Chan"),
+        ("Contractor", "ABC Ltd"), ("Form No", ""), ("Insp Type", ""), ("Scheduled", ""),
+        ("Deadline", ""), ("Performed By", ""), ("Checked By", "K. Wong"), ("Date", ""),
+    ]
+
+    @staticmethod
+    def build(path, tables=10, merge_density=0.1, label_position="first", image_kb=0, seed=0):
+        from docx import Document
+
+        rng = random.Random(seed)
+        doc = Document()
+        doc.add_heading("Inspection Form", level=1)
+        label_at = {"first": 0, "last": tables, "spread": tables // 2}[label_position]
+        spread = label_position == "spread"
+
+        for n in range(tables + 1):
+            if n == label_at:
+                SyntheticTemplate._label_table(doc, SyntheticTemplate.LABELS if not spread
+                                               else SyntheticTemplate.LABELS[:4])
+            elif spread and n == tables:
+                SyntheticTemplate._label_table(doc, SyntheticTemplate.LABELS[4:])
+            if n < tables:
+                SyntheticTemplate._filler_table(doc, rng, merge_density)
+                doc.add_paragraph(f"Section {n + 1} remarks.")
+
+        if image_kb:
+            doc.add_picture(io.BytesIO(SyntheticTemplate.png(image_kb * 1024, rng)))
+        doc.save(path)
+        return path
+
+    @staticmethod
+    def _label_table(doc, labels):
+        table = doc.add_table(rows=len(labels), cols=2)
+        for row, (label, value) in zip(table.rows, labels):
+            row.cells[0].text = f"{label}:"
+            row.cells[1].text = value
+
+    @staticmethod
+    def _filler_table(doc, rng, merge_density, rows=6, cols=5):
+        table = doc.add_table(rows=rows, cols=cols)
+        for r in range(rows):
+            for c in range(cols):
+                table.cell(r, c).text = f"Item {r}.{c}"
+        # Merge random 2-cell blocks, horizontally or vertically, up to the requested density
+        for _ in range(int(rows * cols * merge_density / 2)):
+            r, c = rng.randrange(rows - 1), rng.randrange(cols - 1)
+            other = table.cell(r, c + 1) if rng.random() < 0.5 else table.cell(r + 1, c)
+            try:
+                table.cell(r, c).merge(other)
+            except Exception:
+                pass # overlaps an earlier merge into a non-rectangular span
+
+    @staticmethod
+    def png(nbytes, rng):
+        """An incompressible RGB PNG of roughly `nbytes`."""
+        width = 512
+        height = max(1, nbytes // (width * 3))
+        raw = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+        def chunk(tag, body):
+            return struct.pack(">I", len(body)) + tag + body + struct.pack(">I", zlib.crc32(tag + body))
+
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw, 0)) \
+            + chunk(b"IEND", b"")
+
+# ==========================================
+# 3. CASE RUNNERS (executed in a child process)
+# ==========================================
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024 # ru_maxrss is bytes on macOS, KiB on Linux
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / scale, 1)
+
+
+def _timed(forms, latencies, consumer=None):
+    """Passes forms through, appending the latency of each one to `latencies`.
+
+    Time spent by the consumer between forms (e.g. writing the ZIP entry)
+    is appended to `consumer` instead.
+    """
+    last = time.perf_counter()
+    for item in forms:
+        now = time.perf_counter()
+        latencies.append(now - last)
+        yield item
+        last = time.perf_counter()
+        if consumer is not None: consumer.append(last - now)
+
+
+def run_app_case(template_path, req_type, start, end, workers, engine):
+    try:
+        import app
+    except ImportError as e:
+        return {"status": f"skipped: {e}"}
+    from formengine import write_zip
+
+    with open(template_path, "rb") as f:
+        upload = io.BytesIO(f.read())
+
+    # Forms stream straight into the ZIP as in the app; time inside write_zip counts as ZIP time
+    latencies, zip_times = [], []
+    started = time.perf_counter()
+    archive, count = write_zip(_timed(app.generate_docs_in_memory(
+        upload, dict(BenchConfig.FORM_DATA), start, end, req_type, 1, engine=engine, workers=workers, seed=0
+    ), latencies, zip_times))
+    zip_seconds = sum(zip_times)
+    render_seconds = time.perf_counter() - started - zip_seconds
+    archive_bytes = archive.seek(0, io.SEEK_END)
+    archive.close()
+    return {"forms": count, "render_seconds": render_seconds, "zip_seconds": zip_seconds,
+            "output_bytes": archive_bytes, "latencies": latencies}
+
+
+def run_cli_case(template_path, req_type, start, end, workers, engine):
+    import inspectionformgenerator as cli
+
+    load_started = time.perf_counter()
+    template = cli.InspectionTemplate(template_path, engine=engine, verbose=False)
+    load_seconds = time.perf_counter() - load_started
+
+    generator = cli.FormGenerator(template, workers)
+    latencies = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        started = time.perf_counter()
+        assignments = generator.plan_range(req_type, start, end, seed=0)
+        count = sum(1 for _ in _timed(generator.write_forms(out_dir, assignments), latencies))
+        render_seconds = time.perf_counter() - started
+        output_bytes = sum(os.path.getsize(os.path.join(out_dir, f)) for f in os.listdir(out_dir))
+    return {"forms": count, "load_seconds": load_seconds, "render_seconds": render_seconds,
+            "zip_seconds": None, "output_bytes": output_bytes, "latencies": latencies}
+
+
+def run_case(case):
+    runner = {"app": run_app_case, "cli": run_cli_case}[case["entry_point"]]
+    start, end = BenchConfig.RANGES[case["range"]]
+    result = runner(case["template_path"], case["type"], start, end, case["workers"], case["engine"])
+
+    latencies = sorted(result.pop("latencies", []))
+    if latencies:
+        total = result["render_seconds"] + (result["zip_seconds"] or 0)
+        result.update({
+            "status": "ok",
+            "latency_ms_mean": 1000 * sum(latencies) / len(latencies),
+            "latency_ms_p50": 1000 * latencies[len(latencies) // 2],
+            "latency_ms_max": 1000 * latencies[-1],
+            "forms_per_sec": result["forms"] / total if total else None,
+        })
+    result["peak_rss_mb"] = _peak_rss_mb()
+    return result
+
+# ==========================================
+# 4. BENCHMARK DRIVER
+# ==========================================
+class Benchmark:
+    """Builds the templates once and runs every case in its own interpreter."""
+
+    def __init__(self, templates, ranges, entry_points, req_type="SAFE", workers=1, engine="splice"):
+        self.templates = templates
+        self.ranges = ranges
+        self.entry_points = entry_points
+        self.req_type = req_type
+        self.workers = workers
+        self.engine = engine
+
+    def run(self, output):
+        meta = self._metadata()
+        with tempfile.TemporaryDirectory() as work_dir:
+            paths = {}
+            for name in self.templates:
+                path = os.path.join(work_dir, f"bench_{name}_{self.req_type}.docx")
+                paths[name] = SyntheticTemplate.build(path, **BenchConfig.TEMPLATES[name])
+
+            with open(output, "a", encoding="utf-8") as out:
+                for name in self.templates:
+                    for range_name in self.ranges:
+                        for entry_point in self.entry_points:
+                            case = {"template": name, "range": range_name, "entry_point": entry_point,
+                                    "type": self.req_type, "workers": self.workers, "engine": self.engine,
+                                    "template_path": paths[name]}
+                            result = self._run_isolated(case)
+                            case.pop("template_path")
+                            record = {**meta, **case, **BenchConfig.TEMPLATES[name],
+                                      "template_bytes": os.path.getsize(paths[name]), **result}
+                            out.write(json.dumps(record) + "\n")
+                            out.flush()
+                            self._print_line(record)
+        print(f"\n>> Results appended to {output}")
+
+    @staticmethod
+    def _run_isolated(case):
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+                              capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if proc.returncode != 0:
+            return {"status": "failed: " + (proc.stderr.strip().splitlines() or ["?"])[-1]}
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+    @staticmethod
+    def _metadata():
+        here = os.path.dirname(os.path.abspath(__file__))
+        try:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                    capture_output=True, text=True).stdout.strip() or None
+        except OSError:
+            commit = None
+        return {"timestamp": datetime.now().isoformat(timespec="seconds"), "commit": commit,
+                "python": platform.python_version(), "platform": platform.platform(),
+                "cpus": os.cpu_count()}
+
+    @staticmethod
+    def _print_line(r):
+        if r.get("status") != "ok":
+            print(f"{r['template']:>8} {r['range']:>8} {r['entry_point']:>4}: {r.get('status')}")
+            return
+        zip_ms = f"{1000 * r['zip_seconds']:.0f}ms" if r["zip_seconds"] is not None else "-"
+        print(f"{r['template']:>8} {r['range']:>8} {r['entry_point']:>4}: {r['forms']:>4} forms "
+              f"{r['forms_per_sec']:>8.1f}/s  p50 {r['latency_ms_p50']:.1f}ms  zip {zip_ms}  "
+              f"rss {r['peak_rss_mb']}MB")
+
+# ==========================================
+# 5. ENTRY POINT
+# ==========================================
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark form generation on synthetic templates.")
+    parser.add_argument("--templates", nargs="+", choices=list(BenchConfig.TEMPLATES),
+                        default=list(BenchConfig.TEMPLATES))
+    parser.add_argument("--ranges", nargs="+", choices=list(BenchConfig.RANGES), default=list(BenchConfig.RANGES))
+    parser.add_argument("--entry-points", nargs="+", choices=BenchConfig.ENTRY_POINTS,
+                        default=BenchConfig.ENTRY_POINTS)
+    parser.add_argument("--quick", action="store_true", help="Skip the 10-year range")
+    parser.add_argument("--type", default="SAFE", help="Inspection type to generate (default: SAFE)")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--engine", default="splice", help="Render engine: splice or docx")
+    parser.add_argument("--output", default="benchmark_results.jsonl", help="JSON lines file to append to")
+    parser.add_argument("--run-case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(json.loads(args.run_case))))
+        sys.exit(0)
+
+    ranges = [r for r in args.ranges if not (args.quick and r == "10-year")]
+    Benchmark(args.templates, ranges, args.entry_points, args.type.upper(), args.workers, args.engine) \
+        .run(args.output)
@@ -0,0 +1,2033 @@
+import bisect
+import calendar
+import hashlib
+import html
+import io
+import json
+import os
+import posixpath
+import random
+import re
+import shutil
+import sqlite3
+import struct
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+import zipfile
+import zlib
+from array import array
+from itertools import islice
+from collections import OrderedDict, deque
+from contextlib import closing, contextmanager, nullcontext
+from datetime import date, datetime
+
+# python-docx, lxml and the process pool are imported where first used, so
+# frontends that only plan, extract or verify start without loading them.
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# ==========================================
+# 1. CONFIGURATION
+# ==========================================
+class Config:
+    VALID_INSP_TYPES = ["RGI", "SAFE", "WSIN", "ENVI"]
+
+    KEY_MAPPING = {
+        "PI Inspection Form": "location",
+        "Project No": "project_no",
+        "Inspector": "inspector",
+        "Contractor": "contractor",
+        "Form No": "form_no",
+        "Insp Type": "insp_type",
+        "Scheduled": "scheduled",
+        "Deadline": "deadline",
+        "Performed By": "inspector",
+        "Checked By": "checker",
+        "Date": "perform_date",
+    }
+
+    # Labels whose neighbouring cell holds a project detail in the template
+    DETAIL_KEYS = {
+        "PI Inspection Form": "location", "Location": "location",
+        "Project No": "project_no", "Inspector": "inspector",
+        "Contractor": "contractor", "Checked By": "checker"
+    }
+
+    # Generated archives stay in memory up to this size, then spill to disk
+    ZIP_SPOOL_BYTES = 32 * 1024 * 1024
+
+    # Forms per worker task when rendering a streamed source of unknown length
+    RENDER_BATCH = 8
+
+    # Memory budget for compiled templates shared by all sessions of a process,
+    # and how many templates each manifest/watch worker process keeps compiled
+    TEMPLATE_CACHE_BYTES = 256 * 1024 * 1024
+    MANIFEST_TEMPLATE_CACHE = 8
+
+    # Background generation jobs running at once, and how long (s) a finished ZIP is kept
+    MAX_BACKGROUND_JOBS = 2
+    JOB_RESULT_TTL = 3600
+
+    # Mail-merge rows the web app plans up front for review; the rest stream at generation
+    MERGE_PREVIEW_ROWS = 100
+
+    # Shared form-number sequences, and how many numbers a streamed source reserves at a time
+    FORM_NUMBER_DB = os.path.join(os.path.expanduser("~"), ".inspection_form_numbers.sqlite3")
+    FORM_NUMBER_BLOCK = 100
+
+    # Archive of every generated form, and how many index rows are written per transaction
+    ARCHIVE_DIR = os.path.join(os.path.expanduser("~"), ".inspection_form_archive")
+    ARCHIVE_COMMIT_EVERY = 200
+    ARCHIVE_SEARCH_LIMIT = 10000 # rows one web app search returns at most
+
+    # Watch-folder mode: seconds between scans, and how long a new file must stay unchanged
+    WATCH_INTERVAL = 2.0
+    WATCH_SETTLE = 3.0
+
+    # HTTP API: default port, largest template upload accepted, and ZIP response chunk size
+    SERVER_PORT = 8765
+    SERVER_MAX_UPLOAD = 64 * 1024 * 1024
+    SERVER_CHUNK_BYTES = 256 * 1024
+
+    # Slots an audit checks in every generated form
+    AUDIT_FIELDS = ("form_no", "perform_date", "scheduled", "deadline")
+
+
+def detect_type(filename):
+    """The inspection type named in a template's filename, or "UNKNOWN" if none is."""
+    fname_upper = filename.upper()
+    for type_code in Config.VALID_INSP_TYPES:
+        if type_code in fname_upper:
+            return type_code
+    return "UNKNOWN"
+
+# ==========================================
+# 2. DOCUMENT UTILITIES (Static Helpers)
+# ==========================================
+class DocUtils:
+    """Static helper methods for low-level Docx manipulation."""
+
+    @staticmethod
+    def match_labels(text, key_mapping):
+        """Returns the (key, field) pairs whose label appears in the cell text."""
+        matches = []
+        for key, field in key_mapping.items():
+            if key in text:
+                if key == "Inspector" and "PI Inspection" in text: continue
+                matches.append((key, field))
+        return matches
+
+    @staticmethod
+    def find_next_real_cell(row_cells, current_index):
+        """Skips merged cells to find the actual value cell."""
+        current_cell = row_cells[current_index]
+        next_index = current_index + 1
+        while next_index < len(row_cells):
+            next_cell = row_cells[next_index]
+            if next_cell._element is not current_cell._element:
+                return next_cell
+            next_index += 1
+        return None
+
+    @staticmethod
+    def safe_update_cell(cell, new_value):
+        """Updates cell text preserving format."""
+        if not cell: return
+        if cell.paragraphs:
+            p = cell.paragraphs[0]
+            if p.runs:
+                p.runs[0].text = str(new_value)
+                for run in p.runs[1:]:
+                    run.text = ""
+            else:
+                p.add_run(str(new_value))
+        else:
+            cell.text = str(new_value)
+
+
+class TableIndex:
+    """Merged-cell-aware grid of one table, built in a single pass over its XML.
+
+    Each row is reduced to its unique cells in order: a horizontal span is
+    listed once and a vertical continuation resolves to the cell it continues,
+    exactly as `row.cells` reports them. Every entry carries the cell's
+    stripped text and its real right-hand neighbour (what
+    `DocUtils.find_next_real_cell` returns), so scans never rebuild
+    `row.cells` or walk spans again.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.rows = []   # per row: [(cell, text, next cell or None)]
+        self.texts = {}  # tc -> stripped text when indexed
+        self._build()
+
+    def _build(self):
+        from docx.table import _Cell
+
+        cells = {} # root tc -> _Cell, shared by every row it spans
+        above = {} # grid offset -> root tc in the previous row
+        for tr in self.table._tbl.tr_lst:
+            offset = tr.grid_before
+            here, row = {}, []
+            for tc in tr.tc_lst:
+                root = tc
+                if tc.vMerge == "continue":
+                    root = above.get(offset, tc)
+                here[offset] = root
+                offset += tc.grid_span
+                if row and row[-1] is root: continue
+                row.append(root)
+            above = here
+
+            for root in row:
+                if root not in cells:
+                    cells[root] = _Cell(root, self.table)
+                    self.texts[root] = cells[root].text.strip()
+            self.rows.append([
+                (cells[root], self.texts[root], cells[row[n + 1]] if n + 1 < len(row) else None)
+                for n, root in enumerate(row)
+            ])
+
+    def __iter__(self):
+        for row in self.rows:
+            yield from row
+
+    def text_of(self, cell):
+        return self.texts[cell._tc]
+
+class LabelMatcher:
+    """One compiled pattern over every label of a key map.
+
+    Most cells hold none of the labels, so a single regex search rejects
+    them without looping over the map; hits are confirmed with
+    `DocUtils.match_labels` so the result is exactly the same.
+    """
+
+    def __init__(self, key_mapping):
+        self.key_mapping = key_mapping
+        self._pattern = re.compile("|".join(map(re.escape, key_mapping)))
+
+    def match(self, text):
+        if not self._pattern.search(text):
+            return []
+        return DocUtils.match_labels(text, self.key_mapping)
+
+
+def story_parts(doc):
+    """The document's stories: the main body, then each header and footer part."""
+    from docx.opc.constants import RELATIONSHIP_TYPE as RT
+
+    parts = [doc.part]
+    for rel in doc.part.rels.values():
+        if not rel.is_external and rel.reltype in (RT.HEADER, RT.FOOTER) and rel.target_part not in parts:
+            parts.append(rel.target_part)
+    return parts
+
+
+def story_tables(part):
+    """Every table of a story exactly once, in one walk over its XML.
+
+    Tables nested in cells or sitting in text boxes are included. Tables
+    come in the order they close, so a nested table precedes the table
+    holding it; each table's cells are then read from its direct rows only.
+    """
+    from docx.table import Table
+    from lxml import etree
+
+    tables = [tbl for _, tbl in etree.iterwalk(part.element, events=("end",), tag=_W + "tbl")]
+    return [Table(tbl, part) for tbl in tables]
+
+# ==========================================
+# 3. FILL LOGIC
+# ==========================================
+def scan_fill(doc, data):
+    """Reference fill: scans every cell of every table, in every story, for labels."""
+    for part in story_parts(doc):
+        for table in story_tables(part):
+            written = set()
+            for cell, text, target in TableIndex(table):
+                if cell._tc in written: text = cell.text.strip()
+                for key, field in DocUtils.match_labels(text, Config.KEY_MAPPING):
+                    if target:
+                        DocUtils.safe_update_cell(target, data.get(field, ""))
+                        written.add(target._tc)
+    return doc
+
+
+_EPOCH_DOS = struct.pack("<HH", 0, (1 << 5) | 1) # DOS time and date of 1980-01-01 00:00
+
+
+def _epoch_dated(package):
+    """Returns a saved .docx with every entry dated 1980-01-01, as Word saves them.
+
+    `Document.save` stamps entries with the current time; without it, equal
+    content always gives equal bytes. Only the date fields of the local and
+    central headers are patched, so nothing is recompressed.
+    """
+    out = bytearray(package)
+    with zipfile.ZipFile(io.BytesIO(package)) as zf:
+        offsets = [info.header_offset for info in zf.infolist()]
+        central = zf.start_dir
+    for offset in offsets:
+        out[offset + 10:offset + 14] = _EPOCH_DOS
+        out[central + 12:central + 16] = _EPOCH_DOS
+        name_len, extra_len, comment_len = struct.unpack("<HHH", out[central + 28:central + 34])
+        central += 46 + name_len + extra_len + comment_len
+    return bytes(out)
+
+
+class CompiledTemplate:
+    """A template whose label scan has been resolved into fill slots once.
+
+    Compiling replays `scan_fill` on a scratch copy, writing a placeholder
+    instead of real values, and records every (story, cell) -> field write.
+    Filling a form then only touches those slots. A cell that is written and
+    later scanned as a label (e.g. a label sitting right of another label) is
+    kept as a guard: if a real value would change what that cell matches, the
+    form falls back to `scan_fill` so the output always equals the reference.
+    """
+
+    PLACEHOLDER = "\ue000\ue001"
+
+    def __init__(self, template_bytes):
+        self.template_bytes = template_bytes
+        self.digest = hashlib.sha256(template_bytes).hexdigest()
+        self.slots = {}   # story index -> [(tc index within the story, field)]
+        self.guards = []  # [(scanned text, field written there, matches)]
+        self._compile()
+
+    def _compile(self):
+        from docx import Document
+
+        doc = Document(io.BytesIO(self.template_bytes))
+        for s_idx, part in enumerate(story_parts(doc)):
+            slots = []
+            for table in story_tables(part):
+                written = {}  # tc -> field of the last write
+                for cell, text, target in TableIndex(table):
+                    guarded = cell._tc in written
+                    if guarded: text = cell.text.strip()
+                    matches = DocUtils.match_labels(text, Config.KEY_MAPPING)
+                    if guarded:
+                        self.guards.append((text, written[cell._tc], matches))
+                    for key, field in matches:
+                        if target:
+                            DocUtils.safe_update_cell(target, self.PLACEHOLDER)
+                            written[target._tc] = field
+                slots.extend(written.items())
+            if slots:
+                tc_index = {tc: n for n, tc in enumerate(part.element.iter(_W + "tc"))}
+                self.slots[s_idx] = [(tc_index[tc], field) for tc, field in slots]
+
+    def _slot_cells(self, doc):
+        """Yields (cell, field) for every slot of a fresh copy of the template."""
+        from docx.table import _Cell
+
+        parts = story_parts(doc)
+        for s_idx, slots in self.slots.items():
+            part = parts[s_idx]
+            tcs = list(part.element.iter(_W + "tc"))
+            for tc_idx, field in slots:
+                yield _Cell(tcs[tc_idx], part), field
+
+    @property
+    def nbytes(self):
+        """Approximate memory held by this compiled template."""
+        return len(self.template_bytes)
+
+    def _guards_hold(self, data):
+        for text, field, matches in self.guards:
+            real_text = text.replace(self.PLACEHOLDER, str(data.get(field, "")))
+            if DocUtils.match_labels(real_text, Config.KEY_MAPPING) != matches:
+                return False
+        return True
+
+    def fill(self, data):
+        """Returns a new Document with the form data written into every slot."""
+        from docx import Document
+
+        doc = Document(io.BytesIO(self.template_bytes))
+        if not self._guards_hold(data):
+            return scan_fill(doc, data)
+
+        for cell, field in self._slot_cells(doc):
+            DocUtils.safe_update_cell(cell, data.get(field, ""))
+        return doc
+
+    def render(self, data):
+        """Returns the filled form as .docx bytes."""
+        profiler = current_profiler()
+        with profiler.stage("fill"):
+            doc = self.fill(data)
+        with profiler.stage("save"):
+            stream = io.BytesIO()
+            doc.save(stream)
+            return _epoch_dated(stream.getvalue())
+
+    def preview(self, data):
+        """Returns the filled form's body as HTML (see `document_html`), without saving a .docx."""
+        with current_profiler().stage("preview"):
+            return document_html(self.document_xml(data))
+
+    def document_xml(self, data):
+        """Returns only the filled main document XML (see `combine_documents`)."""
+        with current_profiler().stage("fill"):
+            return self.fill(data).part.blob
+
+# ==========================================
+# 4. XML SPLICING FAST PATH
+# ==========================================
+class SpliceTemplate(CompiledTemplate):
+    """Emits forms without parsing the template again.
+
+    The template is unpacked once: every story holding slots (the main
+    document, headers, footers) is filled with a numbered marker per slot,
+    serialized exactly as python-docx would save it, and split around the
+    markers. Each form is then the fixed fragments joined with the escaped
+    values, and every other ZIP member is copied from the template as raw
+    compressed bytes. Anything the splice cannot
+    reproduce exactly (failed guards, non-XML characters, an unusual
+    package) goes through `CompiledTemplate.render`, the reference path.
+    """
+
+    MARKER_RE = re.compile("<w:t>\ue000(\\d+)\ue001</w:t>".encode("utf-8"))
+    XML_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+    INVALID_XML_RE = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+    def __init__(self, template_bytes):
+        self.stories = None  # [(member name, fixed XML fragments, field at each split)]; None disables splicing
+        super().__init__(template_bytes)
+        self._split()
+
+    def _split(self):
+        from docx import Document
+
+        doc = Document(io.BytesIO(self.template_bytes))
+        fields = []
+        for cell, field in self._slot_cells(doc):
+            DocUtils.safe_update_cell(cell, f"\ue000{len(fields)}\ue001")
+            fields.append(field)
+
+        stories, order = [], []
+        for part in story_parts(doc):
+            pieces = self.MARKER_RE.split(part.blob)
+            if part is doc.part or len(pieces) > 1: # the main document is always listed first
+                numbers = [int(n) for n in pieces[1::2]]
+                stories.append((part.partname.lstrip("/"), pieces[0::2], [fields[n] for n in numbers]))
+                order.extend(numbers)
+        if sorted(order) != list(range(len(fields))):
+            return
+
+        try:
+            self.package = _RawPackage(self.template_bytes, [name for name, _, _ in stories])
+        except (zipfile.BadZipFile, KeyError, ValueError):
+            return
+        self.stories = stories
+
+    @property
+    def nbytes(self):
+        spliced = 0
+        if self.stories is not None:
+            spliced += sum(len(f) for _, fragments, _ in self.stories for f in fragments)
+            spliced += sum(len(record) for _, record in self.package.members if record)
+        return super().nbytes + spliced
+
+    @staticmethod
+    def run_content_xml(value):
+        """Serializes run text the way python-docx's run.text setter does."""
+        out = []
+        for chunk in re.split(r"([\t\r\n])", value):
+            if chunk == "\t":
+                out.append("<w:tab/>")
+            elif chunk in ("\r", "\n"):
+                out.append("<w:br/>")
+            elif chunk:
+                space = ' xml:space="preserve"' if chunk.strip() != chunk else ""
+                out.append(f"<w:t{space}>{chunk.translate(SpliceTemplate.XML_ESCAPES)}</w:t>")
+        return "".join(out)
+
+    def render(self, data):
+        """Returns the filled form as .docx bytes."""
+        spliced = self._spliced_xml(data)
+        if spliced is None:
+            return super().render(data)
+        with current_profiler().stage("package"):
+            return self.package.build(spliced)
+
+    def document_xml(self, data):
+        spliced = self._spliced_xml(data)
+        if spliced is None:
+            return super().document_xml(data)
+        return spliced[self.stories[0][0]]
+
+    def _spliced_xml(self, data):
+        """The spliced XML of each story by member name, or None if the form needs the reference path."""
+        if self.stories is None or not self._guards_hold(data):
+            return None
+        values = {field: str(data.get(field, "")) for _, _, fields in self.stories for field in fields}
+        if any(self.INVALID_XML_RE.search(v) for v in values.values()):
+            return None
+        with current_profiler().stage("splice"):
+            return {
+                name: self._splice(fragments, [values[field] for field in fields])
+                for name, fragments, fields in self.stories
+            }
+
+    def _splice(self, fragments, values):
+        """Joins one story's XML fragments around the escaped slot values."""
+        fragments = list(fragments)
+        contents = []
+        for i, value in enumerate(values):
+            content = self.run_content_xml(value).encode("utf-8")
+            # An emptied run without properties serializes as <w:r/>
+            if not content and fragments[i].endswith(b"<w:r>") and fragments[i + 1].startswith(b"</w:r>"):
+                fragments[i] = fragments[i][:-5] + b"<w:r/>"
+                fragments[i + 1] = fragments[i + 1][6:]
+            contents.append(content)
+
+        pieces = [fragments[0]]
+        for content, fragment in zip(contents, fragments[1:]):
+            pieces.append(content)
+            pieces.append(fragment)
+        return b"".join(pieces)
+
+
+class _RawPackage:
+    """The template ZIP split into reusable raw member records.
+
+    Only the spliced story members are recompressed per form; the local
+    headers and compressed data of all other members are copied verbatim.
+    """
+
+    def __init__(self, template_bytes, document_names):
+        self.document_names = set(document_names)
+        self.members = []  # [(ZipInfo, local record bytes or None for a spliced story)]
+        with zipfile.ZipFile(io.BytesIO(template_bytes)) as zf:
+            infos = zf.infolist()
+        missing = self.document_names - {info.filename for info in infos}
+        if missing:
+            raise KeyError(sorted(missing)[0])
+
+        for info in infos:
+            if info.flag_bits & 0x1 or max(info.file_size, info.compress_size, info.header_offset) >= 0xFFFFFFFF:
+                raise ValueError(f"Unsupported ZIP member: {info.filename}")
+            info.flag_bits &= ~0x8  # sizes go in the local header, no data descriptor
+            if info.filename in self.document_names:
+                self.members.append((info, None))
+                continue
+            name_len, extra_len = struct.unpack("<HH", template_bytes[info.header_offset + 26:info.header_offset + 30])
+            start = info.header_offset + 30 + name_len + extra_len
+            data = template_bytes[start:start + info.compress_size]
+            self.members.append((info, self._local_header(info, info.CRC, len(data), info.file_size) + data))
+
+    @staticmethod
+    def _name_bytes(info):
+        return info.filename.encode("utf-8" if info.flag_bits & 0x800 else "cp437")
+
+    @staticmethod
+    def _dos_time(info):
+        y, mo, d, h, mi, s = info.date_time
+        return (h << 11) | (mi << 5) | (s // 2), ((y - 1980) << 9) | (mo << 5) | d
+
+    def _local_header(self, info, crc, compress_size, file_size):
+        name = self._name_bytes(info)
+        dos_time, dos_date = self._dos_time(info)
+        return struct.pack(
+            "<IHHHHHIIIHH", 0x04034B50, 20, info.flag_bits, info.compress_type,
+            dos_time, dos_date, crc, compress_size, file_size, len(name), 0,
+        ) + name
+
+    def _central_record(self, info, crc, compress_size, file_size, offset):
+        name = self._name_bytes(info)
+        dos_time, dos_date = self._dos_time(info)
+        return struct.pack(
+            "<IHHHHHHIIIHHHHHII", 0x02014B50, info.create_version, 20, info.flag_bits,
+            info.compress_type, dos_time, dos_date, crc, compress_size, file_size,
+            len(name), 0, 0, 0, info.internal_attr, info.external_attr, offset,
+        ) + name
+
+    def build(self, documents):
+        """Returns the package bytes with each spliced story's XML from `documents` (name -> XML)."""
+        out, central, offset = [], [], 0
+        for info, record in self.members:
+            if record is None:
+                document_xml = documents[info.filename]
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                doc_data = compressor.compress(document_xml) + compressor.flush()
+                doc_crc = zlib.crc32(document_xml)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                record = self._local_header(info, doc_crc, len(doc_data), len(document_xml)) + doc_data
+                central.append(self._central_record(info, doc_crc, len(doc_data), len(document_xml), offset))
+            else:
+                central.append(self._central_record(info, info.CRC, info.compress_size, info.file_size, offset))
+            out.append(record)
+            offset += len(record)
+
+        central_dir = b"".join(central)
+        end = struct.pack("<IHHHHIIH", 0x06054B50, 0, 0, len(central), len(central), len(central_dir), offset, 0)
+        return b"".join(out) + central_dir + end
+
+# ==========================================
+# 5. ENGINE SELECTION
+# ==========================================
+ENGINES = {"splice": SpliceTemplate, "docx": CompiledTemplate}
+
+
+def compile_template(template_bytes, engine="splice"):
+    """Compiles a template with the named engine ("docx" is the reference path)."""
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine '{engine}'. Choose from {list(ENGINES)}")
+    with current_profiler().stage("compile"):
+        return ENGINES[engine](template_bytes)
+
+
+# ==========================================
+# 6. ARCHIVE OUTPUT
+# ==========================================
+def write_zip(files, spool_bytes=Config.ZIP_SPOOL_BYTES):
+    """Streams (filename, docx bytes) pairs into a ZIP as they are produced.
+
+    Each form goes straight into its archive entry, so only one form is held
+    in memory at a time. The archive is a spooled temporary file that moves
+    to disk once it grows past `spool_bytes`. Returns the archive rewound to
+    the start and the number of entries written.
+    """
+    archive = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    count = 0
+    try:
+        profiler = current_profiler()
+        with zipfile.ZipFile(archive, "w") as zf:
+            for fname, content in files:
+                with profiler.stage("zip"), zf.open(fname, "w") as entry:
+                    entry.write(content)
+                count += 1
+    except BaseException:
+        archive.close()
+        raise
+    archive.seek(0)
+    return archive, count
+
+
+def form_documents(template, assignments):
+    """Yields (filename, filled main document XML) for each assignment."""
+    profiler = current_profiler()
+    for fname, data in assignments:
+        with profiler.stage("render"):
+            document_xml = template.document_xml(data)
+        yield fname, document_xml
+
+
+_SECT_PR_RE = re.compile(rb"<w:sectPr[\s/>]")
+_SECT_TYPE_RE = re.compile(rb"<w:type\b[^>]*/>")
+_UNIQUE_ID_RE = re.compile(rb'(<(?:wp:docPr|w:bookmarkStart|w:bookmarkEnd)\b[^>]*?\s(?:w:)?id=")(\d+)"')
+_PAGE_BREAK = b'<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+
+def _split_body(document_xml):
+    """Splits document XML into (head, body content, final sectPr or b"", tail)."""
+    start = document_xml.index(b"<w:body>") + len(b"<w:body>")
+    end = document_xml.rindex(b"</w:body>")
+    body = document_xml[start:end]
+    last = None
+    for last in _SECT_PR_RE.finditer(body):
+        pass
+    # Only a sectPr that is the body's last child describes the document's section
+    if last and (body.endswith(b"</w:sectPr>") or b"<" not in body[last.start() + 1:]):
+        return document_xml[:start], body[:last.start()], body[last.start():], document_xml[end:]
+    return document_xml[:start], body, b"", document_xml[end:]
+
+
+def combine_documents(template, documents, spool_bytes=Config.ZIP_SPOOL_BYTES):
+    """Joins (filename, document XML) pairs into one .docx, one section per form.
+
+    Each form's body ends with a section break carrying the template's page
+    setup (headers, footers, margins), so every form starts on a new page.
+    Header and footer parts are shared by all sections, so any slots in them
+    keep the template's text.
+    Styles, numbering, relationships and media are stored once, straight
+    from the template. Drawing and bookmark ids are offset per form to stay
+    unique. Returns the document as a rewound spooled file and the form count,
+    like `write_zip`.
+    """
+    pieces, head, tail, sect = [], b"", b"", b""
+    count, id_offset = 0, 0
+    for _, document_xml in documents:
+        head, body, form_sect, tail = _split_body(document_xml)
+        if count:
+            # The previous form's section ends here; sections always start on a new page
+            pieces.append(b"<w:p><w:pPr>" + sect + b"</w:pPr></w:p>" if sect else _PAGE_BREAK)
+        ids = [int(m.group(2)) for m in _UNIQUE_ID_RE.finditer(body)]
+        if id_offset and ids:
+            body = _UNIQUE_ID_RE.sub(lambda m: m.group(1) + str(int(m.group(2)) + id_offset).encode() + b'"', body)
+        id_offset += max(ids, default=-1) + 1
+        pieces.append(body)
+        sect = _SECT_TYPE_RE.sub(b"", form_sect)
+        count += 1
+    archive = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    if not count:
+        return archive, 0
+    combined = head + b"".join(pieces) + sect + tail
+
+    with current_profiler().stage("package"):
+        with zipfile.ZipFile(io.BytesIO(template.template_bytes)) as src, zipfile.ZipFile(archive, "w") as dst:
+            document_name = _main_document_name(src)
+            for info in src.infolist():
+                dst.writestr(info, combined if info.filename == document_name else src.read(info))
+    archive.seek(0)
+    return archive, count
+
+
+# ==========================================
+# 7. PARALLEL RENDERING
+# ==========================================
+_worker_templates = None
+
+
+def _init_worker(templates):
+    global _worker_templates
+    _worker_templates = templates
+
+
+def _render_batch_in_worker(n, datas):
+    template = _worker_templates[n]
+    return [template.render(data) for data in datas]
+
+
+def render_forms(template, assignments, workers=1):
+    """Renders (filename, form data) assignments, yielding (filename, docx bytes).
+
+    Dates and form numbers must already be assigned, so every form is
+    independent. With more than one worker the compiled template is sent
+    once to each process of a pool and batches of forms are fanned out
+    across it; results still come back in assignment order, identical to a
+    serial run. Assignments are read lazily and only a few batches are in
+    flight at a time, so a streamed source (e.g. mail-merge rows) never
+    has to fit in memory.
+    """
+    for _, fname, content in render_form_sets([(None, template, assignments)], workers):
+        yield fname, content
+
+
+def _set_batches(form_sets, chunksize):
+    """Yields (set index, batch of assignments), set after set."""
+    for n, (_, _, assignments) in enumerate(form_sets):
+        source = iter(assignments)
+        while batch := list(islice(source, chunksize)):
+            yield n, batch
+
+
+def render_form_sets(form_sets, workers=1):
+    """Renders several templates' forms in one pass, yielding (key, filename, docx bytes).
+
+    `form_sets` holds (key, compiled template, assignments) triples, e.g.
+    one per template of a multi-template request. They share one pool:
+    every template is sent once to each process, and batches of the next
+    set are queued while the last ones of the previous set still render.
+    Results come back set by set in assignment order, as in `render_forms`.
+    """
+    profiler = current_profiler()
+    sizes = [len(assignments) if hasattr(assignments, "__len__") else None for _, _, assignments in form_sets]
+    size = None if None in sizes else sum(sizes)
+    if workers <= 1 or (size is not None and size < 2):
+        for key, template, assignments in form_sets:
+            for fname, data in assignments:
+                with profiler.stage("render"):
+                    content = template.render(data)
+                yield key, fname, content
+        return
+
+    chunksize = max(1, size // (workers * 4)) if size else Config.RENDER_BATCH
+    from concurrent.futures import ProcessPoolExecutor
+
+    templates = [template for _, template, _ in form_sets]
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(templates,))
+    batches = _set_batches(form_sets, chunksize)
+    pending = deque() # (key, names, future) in assignment order
+    try:
+        while True:
+            for n, batch in islice(batches, workers * 2 - len(pending)):
+                names = [fname for fname, _ in batch]
+                future = pool.submit(_render_batch_in_worker, n, [data for _, data in batch])
+                pending.append((form_sets[n][0], names, future))
+            if not pending:
+                break
+            key, names, future = pending.popleft()
+            with profiler.stage("render"):
+                contents = future.result()
+            for fname, content in zip(names, contents):
+                yield key, fname, content
+    finally:
+        # A run abandoned part way (e.g. a cancelled job) drops its queued forms
+        pool.shutdown(cancel_futures=True)
+
+
+# ==========================================
+# 8. TEMPLATE CACHE
+# ==========================================
+class TemplateCache:
+    """Process-wide LRU of compiled templates and extraction results.
+
+    Entries are keyed by the SHA-256 of the template bytes plus a kind
+    (e.g. the engine name or "details"), so the same company template
+    uploaded by different users is only parsed once. The least recently
+    used entries are evicted once their estimated size exceeds `max_bytes`.
+    """
+
+    def __init__(self, max_bytes=Config.TEMPLATE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._entries = OrderedDict() # key -> (value, nbytes)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(template_bytes):
+        return hashlib.sha256(template_bytes).hexdigest()
+
+    @staticmethod
+    def _sizeof(value):
+        if hasattr(value, "nbytes"):
+            return value.nbytes
+        if isinstance(value, dict):
+            return sum(len(str(k)) + len(str(v)) for k, v in value.items())
+        return len(str(value))
+
+    def lookup(self, key):
+        """Returns the cached value for key, or None on a miss."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        return None
+
+    def get(self, key, builder):
+        """Returns the cached value for key, building and storing it on a miss."""
+        value = self.lookup(key)
+        if value is not None:
+            return value
+
+        # Build outside the lock so other sessions are not blocked meanwhile
+        value = builder()
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries or size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.total_bytes -= evicted
+        return value
+
+    def compiled(self, template_bytes, engine="splice", digest=None):
+        """Returns the compiled template for these bytes, compiling on a miss."""
+        digest = digest or self.digest(template_bytes)
+        return self.get((digest, engine), lambda: compile_template(template_bytes, engine))
+
+
+template_cache = TemplateCache()
+
+
+# ==========================================
+# 9. STREAMING EXTRACTION
+# ==========================================
+_RUN_TEXT = {_W + "tab": "\t", _W + "ptab": "\t", _W + "cr": "\n", _W + "noBreakHyphen": "-"}
+
+
+def _run_text(r):
+    parts = []
+    for e in r.iterchildren():
+        if e.tag == _W + "t":
+            parts.append(e.text or "")
+        elif e.tag == _W + "br":
+            parts.append("\n" if e.get(_W + "type", "textWrapping") == "textWrapping" else "")
+        else:
+            parts.append(_RUN_TEXT.get(e.tag, ""))
+    return "".join(parts)
+
+
+def _paragraph_text(p):
+    parts = []
+    for child in p.iterchildren(_W + "r", _W + "hyperlink"):
+        runs = [child] if child.tag == _W + "r" else child.iterchildren(_W + "r")
+        parts.extend(_run_text(r) for r in runs)
+    return "".join(parts)
+
+
+def _cell_text(tc):
+    """Same text as python-docx's cell.text, read straight from the XML."""
+    return "\n".join(_paragraph_text(p) for p in tc.iterchildren(_W + "p")).strip()
+
+
+def _tc_prop(tc, name, default=None):
+    prop = tc.find(f"{_W}tcPr/{_W}{name}")
+    if prop is None:
+        return default
+    return prop.get(_W + "val", "continue" if name == "vMerge" else default)
+
+
+def _main_document_name(zf):
+    from lxml import etree
+
+    try:
+        rels = etree.fromstring(zf.read("_rels/.rels"))
+    except KeyError:
+        return "word/document.xml"
+    for rel in rels:
+        if rel.get("Type", "").endswith("/officeDocument"):
+            return rel.get("Target").lstrip("/")
+    return "word/document.xml"
+
+
+def _story_names(zf):
+    """Member names of the stories `story_parts` visits, in the same order."""
+    from lxml import etree
+
+    main = _main_document_name(zf)
+    folder, base = posixpath.split(main)
+    names = [main]
+    try:
+        rels = etree.fromstring(zf.read(posixpath.join(folder, "_rels", base + ".rels")))
+    except KeyError:
+        return names
+    for rel in rels:
+        if rel.get("TargetMode") == "External" or not rel.get("Type", "").endswith(("/header", "/footer")):
+            continue
+        target = rel.get("Target")
+        name = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+        if name not in names:
+            names.append(name)
+    return names
+
+
+def _story_rows(zf):
+    """Streams the table rows of every story in `story_tables` order.
+
+    Each row lists its real cells as one-item [text] lists, with spans
+    listed once and a vertical continuation sharing the list of the cell it
+    continues, like `TableIndex`. A table is read from its direct rows when
+    it closes and then discarded.
+    """
+    from lxml import etree
+
+    for name in _story_names(zf):
+        try:
+            stream = zf.open(name)
+        except KeyError:
+            continue
+        with stream:
+            for _, elem in etree.iterparse(stream, events=("end",), tag=(_W + "p", _W + "tbl")):
+                if elem.tag == _W + "p":
+                    parent = elem.getparent()
+                    if parent is not None and parent.tag in (_W + "body", _W + "hdr", _W + "ftr"):
+                        elem.clear() # finished top-level paragraph, nothing left to read
+                    continue
+
+                above = {}
+                for tr in elem.iterchildren(_W + "tr"):
+                    trPr = tr.find(_W + "trPr/" + _W + "gridBefore")
+                    offset = int(trPr.get(_W + "val", 0)) if trPr is not None else 0
+                    here, row = {}, []
+                    for tc in tr.iterchildren(_W + "tc"):
+                        root = above.get(offset) if _tc_prop(tc, "vMerge") == "continue" else None
+                        root = root or [_cell_text(tc)] # one list per real cell, shared by its spans
+                        here[offset] = root
+                        offset += int(_tc_prop(tc, "gridSpan", 1))
+                        if not row or row[-1] is not root:
+                            row.append(root)
+                    above = here
+                    yield row
+                elem.clear() # the holding cell only reads its own paragraphs
+
+
+def extract_details_from_doc(doc_obj, keys=Config.DETAIL_KEYS):
+    """Reference extraction over a python-docx document (last label wins)."""
+    extracted = {field: "" for field in keys.values()}
+    for part in story_parts(doc_obj):
+        for table in story_tables(part):
+            index = TableIndex(table)
+            for cell, cell_text, target in index:
+                for key, field in DocUtils.match_labels(cell_text, keys):
+                    if target and index.text_of(target):
+                        extracted[field] = index.text_of(target)
+    return extracted
+
+
+def stream_extract_details(template_bytes, keys=Config.DETAIL_KEYS, stop_early=False):
+    """Reads project details without building a python-docx document.
+
+    Only the story XML (main document, then headers and footers) is
+    streamed from the package (embedded photos are never read), row by row
+    through `_story_rows`, and cells are matched with one `LabelMatcher`.
+    Stories and tables come in the order `story_tables` visits them and
+    merged cells resolve like `TableIndex`, so the default full scan
+    returns what `extract_details_from_doc` returns, in every frontend.
+    With `stop_early` the scan ends once every field has a value; a label
+    repeated later in the document then keeps its first value, not its last.
+    """
+    matcher = LabelMatcher(keys)
+    extracted = {field: "" for field in keys.values()}
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zf:
+        for row in _story_rows(zf):
+            for n, (text,) in enumerate(row[:-1]):
+                if row[n + 1][0]:
+                    for key, field in matcher.match(text):
+                        extracted[field] = row[n + 1][0]
+            if stop_early and all(extracted.values()):
+                break
+    return extracted
+
+
+# ==========================================
+# 10. DATE LOGIC
+# ==========================================
+class HKHolidays:
+    """Public holiday dates for Hong Kong (2024-2026), built into a set on first use."""
+    DATA = {
+        2024: "0101 0210 0212 0213 0329 0330 0401 0404 0501 0515 0610 0701 0918 1001 1011 1225 1226",
+        2025: "0101 0129 0130 0131 0404 0418 0419 0421 0501 0505 0531 0701 1001 1007 1029 1225 1226",
+        2026: "0101 0217 0218 0219 0403 0404 0406 0501 0525 0619 0701 0926 1001 1019 1225 1226", # Projected
+    }
+    _dates = None
+
+    @staticmethod
+    def dates():
+        if HKHolidays._dates is None:
+            HKHolidays._dates = frozenset(
+                date(year, int(md[:2]), int(md[2:])) for year, days in HKHolidays.DATA.items() for md in days.split()
+            )
+        return HKHolidays._dates
+
+    @staticmethod
+    def is_holiday(check_date):
+        return check_date in HKHolidays.dates()
+
+
+class BusinessDayScheduler:
+    """Draws perform dates for every month of a range in one batch.
+
+    The business-day calendar (Mon-Fri minus holidays) is built once for
+    the whole range as a byte mask over day ordinals, and each month keeps
+    its business days as a sorted ordinal array. A draw is then a bisect
+    and one RNG call per form. SAFE gets two forms a month (the first in
+    days 1-7, the second at least 14 days later), every other type one.
+    Pass a seed for a repeatable schedule.
+    """
+
+    FORMS_PER_MONTH = {"SAFE": 2}
+
+    def __init__(self, start_date, end_date, holidays=None, seed=None):
+        self.rng = random.Random(seed)
+        self.months = []
+        year, month = start_date.year, start_date.month
+        while (year, month) <= (end_date.year, end_date.month):
+            self.months.append((year, month))
+            month += 1
+            if month > 12:
+                month, year = 1, year + 1
+
+        self.first = date(*self.months[0], 1).toordinal() if self.months else 0
+        last_y, last_m = self.months[-1] if self.months else (1, 1)
+        last = date(last_y, last_m, calendar.monthrange(last_y, last_m)[1]).toordinal()
+        # Ordinal 1 (0001-01-01) is a Monday, so (ordinal + 6) % 7 is the weekday
+        self.mask = bytearray((o + 6) % 7 < 5 for o in range(self.first, last + 1))
+        for holiday in HKHolidays.dates() if holidays is None else holidays:
+            if self.first <= holiday.toordinal() <= last:
+                self.mask[holiday.toordinal() - self.first] = 0
+
+        self.business_days = {} # (year, month) -> array of business-day ordinals
+        for year, month in self.months:
+            start = date(year, month, 1).toordinal() - self.first
+            end = start + calendar.monthrange(year, month)[1]
+            self.business_days[(year, month)] = array(
+                "l", (self.first + i for i in range(start, end) if self.mask[i])
+            )
+
+    def forms_per_month(self, req_type):
+        return self.FORMS_PER_MONTH.get(req_type, 1)
+
+    def _pick(self, year, month, start_day, end_day):
+        last_day = calendar.monthrange(year, month)[1]
+        actual_start, actual_end = max(1, start_day), min(end_day, last_day)
+        if actual_start > actual_end:
+            return date(year, month, actual_end).toordinal()
+
+        days = self.business_days[(year, month)]
+        base = date(year, month, 1).toordinal() - 1
+        lo = bisect.bisect_left(days, base + actual_start)
+        hi = bisect.bisect_right(days, base + actual_end)
+        if hi > lo:
+            return days[lo + self.rng.randrange(hi - lo)]
+        return base + actual_start
+
+    def draw(self, req_types):
+        """Returns {req_type: array of perform-date ordinals} in month order."""
+        drawn = {}
+        for req_type in req_types:
+            ordinals = array("l")
+            for year, month in self.months:
+                last_day = calendar.monthrange(year, month)[1]
+                if self.forms_per_month(req_type) == 2:
+                    d1 = self._pick(year, month, 1, 7)
+                    ordinals.append(d1)
+                    ordinals.append(self._pick(year, month, date.fromordinal(d1 + 14).day, last_day))
+                else:
+                    ordinals.append(self._pick(year, month, 1, last_day))
+            drawn[req_type] = ordinals
+        return drawn
+
+    def month_dates(self, req_type, ordinals):
+        """Pairs each month with its drawn perform dates."""
+        per = self.forms_per_month(req_type)
+        for n, (year, month) in enumerate(self.months):
+            yield year, month, [date.fromordinal(o) for o in ordinals[n * per:(n + 1) * per]]
+
+
+def reproducible_seed(project_no, req_type, start_date, end_date):
+    """Seed for the date draw derived from the project, type and period.
+
+    Identical requests then draw identical dates (and, with fixed form
+    numbers, render byte-identical forms and archives).
+    """
+    key = f"{project_no}|{req_type}|{start_date:%Y-%m-%d}|{end_date:%Y-%m-%d}"
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:4], "big")
+
+
+def plan_forms(form_data, start_date, end_date, req_type, start_num=1, seed=None, numbers=None):
+    """Assigns every form's number, date and field values as (filename, form data) pairs.
+
+    Dates and numbers are fixed up front, so the forms can then be rendered
+    independently (and in parallel) by either frontend. With `numbers` (see
+    `FormNumberStore.reserver`) the forms take one block of the type and
+    project's shared sequence instead of counting from `start_num`.
+    """
+    with current_profiler().stage("plan"):
+        # Draw every month's perform dates in one batch (holiday aware)
+        scheduler = BusinessDayScheduler(start_date, end_date, seed=seed)
+        ordinals = scheduler.draw([req_type])[req_type]
+
+        assignments = []
+        counter = start_num
+        if numbers is not None and len(ordinals):
+            counter = numbers(req_type, str(form_data.get("project_no", "")), len(ordinals))
+        for year, month, dates in scheduler.month_dates(req_type, ordinals):
+            _, last_day = calendar.monthrange(year, month)
+            month_str = f"{month:02d}"
+            base_data = dict(form_data)
+            base_data["scheduled"] = f"01/{month_str}/{year}"
+            base_data["deadline"] = f"{last_day}/{month_str}/{year}"
+            base_data["insp_type"] = req_type
+
+            for perform_dt in dates:
+                form_no = f"IPRJ{req_type}{counter:04d}"
+                final_data = base_data.copy()
+                final_data["form_no"] = form_no
+                final_data["perform_date"] = perform_dt.strftime("%d/%m/%Y")
+                assignments.append((f"{form_no}.docx", final_data))
+                counter += 1
+        return assignments
+
+
+# ==========================================
+# 11. INCREMENTAL OUTPUT
+# ==========================================
+class OutputManifest:
+    """Fingerprints of the forms last written to an output directory.
+
+    A form's fingerprint covers the template hash, the render engine and
+    every field value (including form number and perform date). The seed
+    of the schedule is kept too, so a rerun draws the same dates and only
+    forms whose inputs really changed are rewritten.
+    """
+
+    FILENAME = ".forms_manifest.json"
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.path = os.path.join(out_dir, self.FILENAME)
+        self.seed = None
+        self.forms = {} # filename -> fingerprint
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self.seed, self.forms = saved.get("seed"), dict(saved.get("forms", {}))
+        except (OSError, ValueError, AttributeError):
+            pass # no usable manifest: everything counts as changed
+
+    @staticmethod
+    def new_seed():
+        return random.SystemRandom().randrange(2 ** 32)
+
+    @staticmethod
+    def fingerprint(template, data):
+        payload = {"template": template.digest, "engine": type(template).__name__, "data": data}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seed": self.seed, "forms": self.forms}, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def _remove_stale(out_dir, fnames):
+    """Removes files a previous manifest listed but this run no longer writes."""
+    for fname in fnames:
+        # Only plain names are ours to remove, whatever a stale or edited manifest lists
+        if fname == os.path.basename(fname) and os.path.exists(os.path.join(out_dir, fname)):
+            os.remove(os.path.join(out_dir, fname))
+
+
+def write_forms_incremental(template, out_dir, assignments, workers=1, manifest=None):
+    """Writes (filename, data) assignments into out_dir, rendering only changed forms.
+
+    Yields (filename, data, status) in assignment order, where status is
+    "new", "updated" or "unchanged". Changed forms are written to a temp
+    file and moved into place, so readers never see a half-written form.
+    Forms listed in the previous manifest but no longer assigned are removed.
+    Assignments are consumed lazily, so they may be a stream of any length.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = manifest or OutputManifest(out_dir)
+    previous = manifest.forms
+    profiler = current_profiler()
+    checked = deque() # (filename, data, fingerprint, status) read ahead by the renderer
+
+    def changed_forms():
+        for fname, data in assignments:
+            with profiler.stage("fingerprint"):
+                fp = OutputManifest.fingerprint(template, data)
+            path = os.path.join(out_dir, fname)
+            if previous.get(fname) == fp and os.path.exists(path):
+                checked.append((fname, data, fp, "unchanged"))
+                continue
+            checked.append((fname, data, fp, "updated" if os.path.exists(path) else "new"))
+            yield fname, data
+
+    current = {}
+    for _, content in render_forms(template, changed_forms(), workers):
+        # Unchanged forms queued ahead of this rendered one are reported first
+        while checked[0][3] == "unchanged":
+            fname, data, fp, status = checked.popleft()
+            current[fname] = fp
+            yield fname, data, status
+        fname, data, fp, status = checked.popleft()
+        path = os.path.join(out_dir, fname)
+        with profiler.stage("write"):
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+        current[fname] = fp
+        yield fname, data, status
+    while checked:
+        fname, data, fp, status = checked.popleft()
+        current[fname] = fp
+        yield fname, data, status
+
+    _remove_stale(out_dir, previous.keys() - current.keys())
+    manifest.forms = current
+    manifest.save()
+
+
+def write_combined_incremental(template, out_dir, fname, assignments, manifest=None):
+    """Writes every assignment into the single combined document out_dir/fname.
+
+    The file is rebuilt only if some form's fingerprint changed, and is
+    swapped in atomically. Returns "new", "updated" or "unchanged". The
+    manifest then lists just this file, so separate forms left by an
+    earlier run (or a combined file left for separate output) are removed.
+    """
+    assignments = list(assignments) # read twice: fingerprints, then the forms themselves
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = manifest or OutputManifest(out_dir)
+    previous = manifest.forms
+    path = os.path.join(out_dir, fname)
+
+    with current_profiler().stage("fingerprint"):
+        combined = hashlib.sha256()
+        for _, data in assignments:
+            combined.update(OutputManifest.fingerprint(template, data).encode("ascii"))
+        fingerprint = combined.hexdigest()
+
+    if previous.get(fname) == fingerprint and os.path.exists(path):
+        status = "unchanged"
+    else:
+        status = "updated" if os.path.exists(path) else "new"
+        archive, _ = combine_documents(template, form_documents(template, assignments))
+        with current_profiler().stage("write"), archive:
+            with open(path + ".tmp", "wb") as f:
+                shutil.copyfileobj(archive, f)
+            os.replace(path + ".tmp", path)
+
+    _remove_stale(out_dir, previous.keys() - {fname})
+    manifest.forms = {fname: fingerprint}
+    manifest.save()
+    return status
+
+
+# ==========================================
+# 12. BACKGROUND JOBS
+# ==========================================
+class JobCancelled(Exception):
+    pass
+
+
+class GenerationJob:
+    """Progress, cancellation flag and result of one background generation run."""
+
+    def __init__(self, label, file_name, owner=None, profile=False):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.file_name = file_name
+        self.owner = owner
+        self.status = "queued" # queued -> running -> done | cancelled | failed
+        self.total = 0 # set by the producer once the forms are planned
+        self.done = 0
+        self.result = None # (output bytes, count) once done
+        self.error = None
+        self.finished_at = None
+        self.profiler = Profiler() if profile else NULL_PROFILER
+        self._cancel = threading.Event()
+
+    @property
+    def finished(self):
+        return self.status in ("done", "cancelled", "failed")
+
+    @property
+    def progress(self):
+        return min(1.0, self.done / self.total) if self.total else 0.0
+
+    def cancel(self):
+        self._cancel.set()
+
+    def track(self, forms):
+        """Passes forms through, counting them and stopping once cancelled."""
+        for item in forms:
+            if self._cancel.is_set():
+                raise JobCancelled()
+            yield item
+            self.done += 1
+        if self._cancel.is_set():
+            raise JobCancelled()
+
+
+class JobManager:
+    """Runs ZIP generation jobs on a bounded thread pool, outside any one request.
+
+    `max_jobs` runs at once and further jobs wait in the queue; each job may
+    still fan its forms out to worker processes. The spooled output file is
+    read into bytes once the job finishes (Streamlit serves downloads from
+    bytes anyway) and closed; finished jobs keep their result for
+    `ttl_seconds` so it survives reruns and page reloads.
+    """
+
+    def __init__(self, max_jobs=Config.MAX_BACKGROUND_JOBS, ttl_seconds=Config.JOB_RESULT_TTL):
+        self.ttl_seconds = ttl_seconds
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._pool = ThreadPoolExecutor(max_workers=max_jobs, thread_name_prefix="formgen")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, label, file_name, produce, owner=None, profile=False, build=write_zip):
+        """Queues a job; `produce(job)` returns the forms that `build` turns into one file.
+
+        By default the forms are (filename, docx bytes) pairs zipped by
+        `write_zip`; `combine_documents` takes document XML instead.
+        """
+        self.purge()
+        job = GenerationJob(label, file_name, owner, profile)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._pool.submit(self._run, job, produce, build)
+        return job
+
+    def _run(self, job, produce, build):
+        if job._cancel.is_set():
+            job.status = "cancelled"
+        else:
+            job.status = "running"
+            try:
+                with profiling(job.profiler):
+                    output, count = build(job.track(produce(job)))
+                with output:
+                    output.seek(0)
+                    job.result = (output.read(), count)
+                job.status = "done"
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                job.status, job.error = "failed", str(e)
+        job.finished_at = time.monotonic()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs_for(self, owner):
+        self.purge()
+        with self._lock:
+            return [job for job in self._jobs.values() if job.owner == owner]
+
+    def discard(self, job_id):
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job:
+            job.cancel()
+            job.result = None # releases the output held for download
+
+    def purge(self):
+        """Drops finished jobs (and their archives) older than the TTL."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and now - job.finished_at > self.ttl_seconds]
+        for job_id in expired:
+            self.discard(job_id)
+
+
+# ==========================================
+# 13. INSTRUMENTATION
+# ==========================================
+class Profiler:
+    """Wall time, call count and tracemalloc peak per pipeline stage.
+
+    Pipeline code wraps each stage in `current_profiler().stage(name)`.
+    Stages may nest; a stage's time includes its children. Memory peaks are
+    tracemalloc's traced bytes while the stage ran, so they are only
+    meaningful for stages running in this process (forms rendered by
+    worker processes show up as the main process waiting in "render").
+    Tracing is process-wide: while several profilers trace at once (e.g.
+    two profiled background jobs of the web app), peaks are no longer reset
+    per stage, so each peak is an upper bound including the other jobs.
+    """
+
+    enabled = True
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stats = {} # name -> [calls, seconds, peak bytes]
+        self._stack = [] # peaks of the open stages
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        tracing = self.trace_memory and tracemalloc.is_tracing()
+        if tracing and _trace_users <= 1: # resetting would cut other profilers' peaks short
+            # The peak is reset for this stage, so carry the running peak up to its parent first
+            if self._stack: self._stack[-1] = max(self._stack[-1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(0)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            peak = max(self._stack.pop(), tracemalloc.get_traced_memory()[1]) if tracing else 0
+            if self._stack: self._stack[-1] = max(self._stack[-1], peak)
+            stat = self.stats.setdefault(name, [0, 0.0, 0])
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], peak)
+
+    def merge(self, report):
+        """Adds another profiler's `report()` (e.g. from a worker process) into this one."""
+        for name, s in report.get("stages", {}).items():
+            stat = self.stats.setdefault(name, [0, 0.0, 0])
+            stat[0] += s["calls"]
+            stat[1] += s["seconds"]
+            stat[2] = max(stat[2], s["peak_kb"] * 1024)
+
+    def report(self):
+        return {
+            "wall_seconds": round(time.perf_counter() - self._started, 6),
+            "stages": {
+                name: {"calls": calls, "seconds": round(seconds, 6), "peak_kb": round(peak / 1024, 1)}
+                for name, (calls, seconds, peak) in self.stats.items()
+            },
+        }
+
+
+class _NullProfiler:
+    """Stand-in used while profiling is off: every stage is a shared no-op context."""
+
+    enabled = False
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return self._stage
+
+    def report(self):
+        return {}
+
+
+NULL_PROFILER = _NullProfiler()
+_profiling = threading.local() # each thread (e.g. each background job) has its own profiler
+_trace_lock = threading.Lock()
+_trace_users = 0       # profilers tracing memory right now, in any thread
+_trace_started = False # tracing was started by them, so the last one stops it
+
+
+def current_profiler():
+    return getattr(_profiling, "profiler", NULL_PROFILER)
+
+
+@contextmanager
+def profiling(profiler):
+    """Makes `profiler` the current profiler of this thread, tracing memory if asked."""
+    global _trace_users, _trace_started
+    trace = profiler.enabled and profiler.trace_memory
+    if trace:
+        with _trace_lock:
+            if not _trace_users and not tracemalloc.is_tracing():
+                tracemalloc.start()
+                _trace_started = True
+            _trace_users += 1
+    previous = current_profiler()
+    _profiling.profiler = profiler
+    try:
+        yield profiler
+    finally:
+        _profiling.profiler = previous
+        if trace:
+            with _trace_lock:
+                _trace_users -= 1
+                if not _trace_users and _trace_started:
+                    tracemalloc.stop()
+                    _trace_started = False
+
+
+# ==========================================
+# 14. MAIL MERGE
+# ==========================================
+_S = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+
+
+class MergeSource:
+    """Streams form rows from a CSV or XLSX file, one dict per row.
+
+    The header row names the fields, either as field names ("project_no")
+    or as the template labels ("Project No", "Performed By"); other
+    columns are ignored. Rows are read one at a time (XLSX sheets are
+    parsed incrementally, keeping only the shared-string table), so the
+    file never has to fit in memory. `source` is a path or a binary file.
+    """
+
+    COLUMNS = {
+        **{label.lower(): field for label, field in Config.KEY_MAPPING.items()},
+        **{field: field for field in Config.KEY_MAPPING.values()},
+    }
+
+    def __init__(self, source, name=None, sheet=None):
+        self.source = source
+        self.name = name or (source if isinstance(source, str) else getattr(source, "name", ""))
+        self.sheet = sheet
+
+    def __iter__(self):
+        rows = self._xlsx_rows() if self.name.lower().endswith((".xlsx", ".xlsm")) else self._csv_rows()
+        header = None
+        for values in rows:
+            if header is None:
+                header = [self.COLUMNS.get(str(v).strip().lower()) for v in values]
+                if not any(header):
+                    raise ValueError(f"No column of {self.name} names a form field {sorted(set(self.COLUMNS.values()))}")
+                continue
+            row = {field: str(v).strip() for field, v in zip(header, values) if field and str(v).strip()}
+            if row:
+                yield row
+
+    def _csv_rows(self):
+        import csv
+
+        if isinstance(self.source, str):
+            with open(self.source, newline="", encoding="utf-8-sig") as f:
+                yield from csv.reader(f)
+        else:
+            yield from csv.reader(io.TextIOWrapper(self.source, encoding="utf-8-sig", newline=""))
+
+    def _xlsx_rows(self):
+        from lxml import etree
+
+        with zipfile.ZipFile(self.source) as zf:
+            shared = []
+            if "xl/sharedStrings.xml" in zf.namelist():
+                with zf.open("xl/sharedStrings.xml") as stream:
+                    for _, si in etree.iterparse(stream, tag=_S + "si"):
+                        shared.append("".join(t.text or "" for t in si.iter(_S + "t") if t.getparent().tag != _S + "rPh"))
+                        si.clear()
+
+            with zf.open(self._sheet_path(zf, etree)) as stream:
+                for _, row in etree.iterparse(stream, tag=_S + "row"):
+                    values = []
+                    for c in row.iterchildren(_S + "c"):
+                        col = self._column(c.get("r"), len(values))
+                        values.extend([""] * (col - len(values)))
+                        kind, v = c.get("t"), c.find(_S + "v")
+                        if kind == "s":
+                            values.append(shared[int(v.text)])
+                        elif kind == "inlineStr":
+                            values.append("".join(t.text or "" for t in c.iter(_S + "t")))
+                        else:
+                            values.append(v.text if v is not None and v.text else "")
+                    yield values
+                    row.clear()
+                    while row.getprevious() is not None:
+                        del row.getparent()[0]
+
+    def _sheet_path(self, zf, etree):
+        workbook = etree.fromstring(zf.read("xl/workbook.xml"))
+        sheets = workbook.findall(f"{_S}sheets/{_S}sheet")
+        if not sheets:
+            raise ValueError(f"{self.name} has no worksheets")
+        chosen = next((s for s in sheets if s.get("name") == self.sheet), None) if self.sheet else sheets[0]
+        if chosen is None:
+            raise ValueError(f"{self.name} has no sheet named '{self.sheet}'")
+        rels = etree.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+        target = next(rel.get("Target") for rel in rels if rel.get("Id") == chosen.get(_R + "id"))
+        return target.lstrip("/") if target.startswith("/") else "xl/" + target
+
+    @staticmethod
+    def _column(ref, default):
+        if not ref:
+            return default
+        col = 0
+        for ch in ref:
+            if not ch.isalpha(): break
+            col = col * 26 + ord(ch.upper()) - 64
+        return col - 1
+
+
+def _merge_date(value):
+    """Reads a merge date given as DD/MM/YYYY, YYYY-MM-DD or an Excel serial number."""
+    value = value.strip()
+    try:
+        if "/" in value:
+            d, m, y = value.split("/")
+            return date(int(y), int(m), int(d))
+        if "-" in value:
+            return date.fromisoformat(value[:10])
+        return date.fromordinal(date(1899, 12, 30).toordinal() + int(float(value)))
+    except ValueError:
+        raise ValueError(f"unreadable date '{value}'") from None
+
+
+_UNSAFE_NAME_RE = re.compile(r'[\\/:*?"<>|\x00-\x1f]|\.\.')
+
+
+def plan_merge(rows, form_data, req_type, start_num=1, numbers=None):
+    """Turns mail-merge rows into (filename, form data) assignments, one per row, lazily.
+
+    Each row's values override `form_data`. Rows without a form number get
+    the next IPRJ<type><n> number, from `start_num` or, with `numbers`, from
+    blocks of `Config.FORM_NUMBER_BLOCK` reserved per type and project as
+    rows arrive; scheduled and deadline default to the first and last day of
+    the perform date's month. Form numbers name the output files, so a row's
+    number may not hold path separators or other characters unsafe in a
+    file name.
+    """
+    counter = start_num
+    blocks = {} # (type, project) -> [next number, end of its reserved block]
+    seen = set()
+    for n, row in enumerate(rows, start=1):
+        data = dict(form_data)
+        data["insp_type"] = req_type
+        data.update(row)
+        try:
+            if "perform_date" in row:
+                performed = _merge_date(row["perform_date"])
+                _, last_day = calendar.monthrange(performed.year, performed.month)
+                data["perform_date"] = performed.strftime("%d/%m/%Y")
+                data.setdefault("scheduled", performed.replace(day=1).strftime("%d/%m/%Y"))
+                data.setdefault("deadline", performed.replace(day=last_day).strftime("%d/%m/%Y"))
+            for field in ("scheduled", "deadline"):
+                if field in row:
+                    data[field] = _merge_date(row[field]).strftime("%d/%m/%Y")
+        except ValueError as e:
+            raise ValueError(f"Merge row {n}: {e}") from None
+
+        if not data.get("form_no"):
+            if numbers is None:
+                number, counter = counter, counter + 1
+            else:
+                sequence = (data["insp_type"], str(data.get("project_no", "")))
+                block = blocks.get(sequence)
+                if block is None or block[0] == block[1]:
+                    first = numbers(*sequence, Config.FORM_NUMBER_BLOCK)
+                    block = blocks[sequence] = [first, first + Config.FORM_NUMBER_BLOCK]
+                number = block[0]
+                block[0] += 1
+            data["form_no"] = f"IPRJ{data['insp_type']}{number:04d}"
+        if _UNSAFE_NAME_RE.search(data["form_no"]) or data["form_no"].strip(" .") != data["form_no"]:
+            raise ValueError(f"Merge row {n}: form number {data['form_no']!r} is not a valid file name")
+        fname = f"{data['form_no']}.docx"
+        if fname in seen:
+            raise ValueError(f"Merge row {n}: duplicate form number {data['form_no']}")
+        seen.add(fname)
+        yield fname, data
+
+
+# ==========================================
+# 15. FORM NUMBERS
+# ==========================================
+class FormNumberStore:
+    """Persistent form-number sequences, one per inspection type and project.
+
+    The sequences live in a local SQLite database in WAL mode, shared by
+    every process and user pointing at it. Numbers are handed out in
+    blocks: a reservation reads and advances its sequence in one immediate
+    transaction, so a batch takes its whole range under a single write lock
+    and parallel jobs never collide. A block reserved under a `key` (e.g.
+    an output folder) is remembered, so a rerun with that key gets the same
+    numbers back and incremental output still applies.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sequences (
+            insp_type TEXT NOT NULL, project_no TEXT NOT NULL, next_num INTEGER NOT NULL,
+            PRIMARY KEY (insp_type, project_no));
+        CREATE TABLE IF NOT EXISTS reservations (
+            key TEXT NOT NULL, insp_type TEXT NOT NULL, project_no TEXT NOT NULL,
+            first_num INTEGER NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (key, insp_type, project_no));
+    """
+
+    def __init__(self, path=Config.FORM_NUMBER_DB, timeout=30.0):
+        self.path = path
+        self.timeout = timeout # seconds to wait for another writer's lock
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        # Autocommit mode, so each reservation opens its own immediate transaction
+        return sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+
+    def reserve(self, insp_type, project_no, count, key=None, start=1):
+        """Reserves `count` consecutive numbers and returns the first.
+
+        A new sequence begins at `start`, and a `start` past an existing
+        sequence moves it forward. If `key` already holds at least `count`
+        numbers of this sequence, that block is returned instead.
+        """
+        with closing(self._connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if key is not None:
+                    held = conn.execute(
+                        "SELECT first_num, count FROM reservations WHERE key = ? AND insp_type = ? AND project_no = ?",
+                        (key, insp_type, project_no),
+                    ).fetchone()
+                    if held and held[1] >= count:
+                        conn.execute("COMMIT")
+                        return held[0]
+                row = conn.execute(
+                    "SELECT next_num FROM sequences WHERE insp_type = ? AND project_no = ?", (insp_type, project_no)
+                ).fetchone()
+                first = max(row[0], start) if row else start
+                conn.execute("INSERT OR REPLACE INTO sequences VALUES (?, ?, ?)", (insp_type, project_no, first + count))
+                if key is not None:
+                    conn.execute("INSERT OR REPLACE INTO reservations VALUES (?, ?, ?, ?, ?)",
+                                 (key, insp_type, project_no, first, count))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return first
+
+    def reserver(self, key=None, start=1):
+        """Returns numbers(insp_type, project_no, count) -> first number, for `plan_forms`/`plan_merge`.
+
+        Every call reserves one block. With a `key`, the n-th block of each
+        sequence is kept under "key#n", so a rerun making the same calls is
+        given the same blocks.
+        """
+        calls = {} # (type, project) -> blocks reserved so far
+        def numbers(insp_type, project_no, count):
+            n = calls.get((insp_type, project_no), 0)
+            calls[(insp_type, project_no)] = n + 1
+            return self.reserve(insp_type, project_no, count, None if key is None else f"{key}#{n}", start)
+        return numbers
+
+
+# ==========================================
+# 16. FORM ARCHIVE
+# ==========================================
+class FormArchive:
+    """Every generated form, indexed for lookup and stored by content hash.
+
+    The index is a SQLite database (WAL mode) with one row per form number,
+    project, type and perform date, holding the file name and the SHA-256
+    of the .docx.
+    The files themselves sit in a content-addressed blob store next to it,
+    so identical forms are stored once and a ZIP of any query result is
+    rebuilt from the blobs without rendering anything. Regenerating a form
+    for the same date replaces its index row; older blobs are kept.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS forms (
+            insp_type TEXT NOT NULL, project_no TEXT NOT NULL, form_no TEXT NOT NULL,
+            perform_date TEXT NOT NULL, filename TEXT NOT NULL, content_hash TEXT NOT NULL,
+            archived_at REAL NOT NULL,
+            PRIMARY KEY (insp_type, project_no, form_no, perform_date));
+        CREATE INDEX IF NOT EXISTS forms_by_project ON forms (project_no, perform_date);
+        CREATE INDEX IF NOT EXISTS forms_by_date ON forms (perform_date);
+        CREATE INDEX IF NOT EXISTS forms_by_number ON forms (form_no);
+    """
+
+    def __init__(self, root=Config.ARCHIVE_DIR, timeout=30.0):
+        self.root = root
+        self.timeout = timeout
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(self.SCHEMA)
+
+    def _connect(self):
+        return sqlite3.connect(os.path.join(self.root, "index.sqlite3"), timeout=self.timeout)
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.root, "blobs", content_hash[:2], content_hash + ".docx")
+
+    def _put_blob(self, content):
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self._blob_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(content)
+            os.replace(tmp, path)
+        return content_hash
+
+    @staticmethod
+    def _iso_date(value):
+        try:
+            return datetime.strptime(str(value), "%d/%m/%Y").date().isoformat()
+        except ValueError:
+            return ""
+
+    @contextmanager
+    def writer(self):
+        """Yields put(filename, form data, docx bytes), archiving one form per call.
+
+        Blobs are written at once; index rows are buffered and committed
+        `Config.ARCHIVE_COMMIT_EVERY` at a time, so parallel writers only
+        hold the database lock for short batches.
+        """
+        rows = []
+
+        def flush():
+            if not rows: return
+            with closing(self._connect()) as conn, conn:
+                conn.executemany("INSERT OR REPLACE INTO forms VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            rows.clear()
+
+        def put(fname, data, content):
+            with current_profiler().stage("archive"):
+                rows.append((
+                    str(data.get("insp_type", "")), str(data.get("project_no", "")), str(data.get("form_no", "")),
+                    self._iso_date(data.get("perform_date", "")), fname, self._put_blob(content), time.time(),
+                ))
+                if len(rows) >= Config.ARCHIVE_COMMIT_EVERY:
+                    flush()
+
+        try:
+            yield put
+        finally:
+            flush()
+
+    def record(self, assignments, render):
+        """Passes `render(assignments)` through, archiving each (filename, docx bytes) it yields."""
+        pending = {} # filename -> form data, for the forms in flight
+        def noted():
+            for fname, data in assignments:
+                pending[fname] = data
+                yield fname, data
+
+        with self.writer() as put:
+            for fname, content in render(noted()):
+                put(fname, pending.pop(fname, {}), content)
+                yield fname, content
+
+    def find(self, project_no=None, insp_type=None, form_no=None, start=None, end=None, limit=None):
+        """Index rows (as dicts) matching every given filter, in perform-date order.
+
+        `form_no` and `project_no` match a substring; `start`/`end` bound the perform date.
+        """
+        where, args = [], []
+        if project_no:
+            where.append("project_no LIKE ?"); args.append(f"%{project_no}%")
+        if insp_type:
+            where.append("insp_type = ?"); args.append(insp_type)
+        if form_no:
+            where.append("form_no LIKE ?"); args.append(f"%{form_no}%")
+        if start:
+            where.append("perform_date >= ?"); args.append(start.isoformat())
+        if end:
+            where.append("perform_date <= ?"); args.append(end.isoformat())
+        sql = "SELECT * FROM forms" + (" WHERE " + " AND ".join(where) if where else "")
+        sql += " ORDER BY perform_date, form_no"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(sql, args)]
+
+    def read(self, content_hash):
+        with open(self._blob_path(content_hash), "rb") as f:
+            return f.read()
+
+    def build_zip(self, rows, spool_bytes=Config.ZIP_SPOOL_BYTES):
+        """Streams the archived forms of `rows` into a ZIP, like `write_zip`.
+
+        Results spanning several projects get a folder per project, and a
+        form number archived for several dates gets the date in its name.
+        """
+        by_project = len({row["project_no"] for row in rows}) > 1
+        def files():
+            names = set()
+            for row in rows:
+                name = f"{row['project_no'] or 'No project'}/{row['filename']}" if by_project else row["filename"]
+                if name in names:
+                    stem, ext = os.path.splitext(name)
+                    name = f"{stem}_{row['perform_date']}{ext}"
+                names.add(name)
+                yield name, self.read(row["content_hash"])
+        return write_zip(files(), spool_bytes)
+
+
+# ==========================================
+# 17. OUTPUT AUDIT
+# ==========================================
+def audit_form(source, expected, fields=Config.AUDIT_FIELDS):
+    """Checks one generated form (path or file object) against its form data.
+
+    The story XML is streamed with `_story_rows` and the label scan of a
+    fill is replayed over it: each cell right of a `Config.KEY_MAPPING`
+    label is owed the value of the last label that wrote to it, and every
+    such cell for one of `fields` must hold that value. Returns the problems
+    as (field, expected value, found text), with None found when no cell
+    keeps the field (no label, or its cell was overwritten by a later
+    label); fields absent from `expected` are not checked.
+    """
+    wanted = {field: str(expected[field]).strip() for field in fields if field in expected}
+    owed = {} # id(cell) -> (cell, field of the last write)
+    matcher = LabelMatcher(Config.KEY_MAPPING)
+    with zipfile.ZipFile(source) as zf:
+        for row in _story_rows(zf):
+            for n, (text,) in enumerate(row[:-1]):
+                for key, field in matcher.match(text):
+                    owed[id(row[n + 1])] = (row[n + 1], field)
+
+    problems, kept = [], set()
+    for (text,), field in owed.values():
+        if field in wanted:
+            kept.add(field)
+            if text != wanted[field]:
+                problems.append((field, wanted[field], text))
+    problems.extend((field, value, None) for field, value in wanted.items() if field not in kept)
+    return problems
+
+
+_audit_zip = None # (path, ZipFile) of the output archive this process reads from
+
+
+def _audit_member(task):
+    """Audits one form of a task: (directory path or ZIP path, member name, form data, fields)."""
+    global _audit_zip
+    container, fname, expected, fields = task
+    try:
+        if os.path.isdir(container):
+            return fname, audit_form(os.path.join(container, fname), expected, fields)
+        if _audit_zip is None or _audit_zip[0] != container:
+            _audit_zip = (container, zipfile.ZipFile(container))
+        with _audit_zip[1].open(fname) as member:
+            return fname, audit_form(io.BytesIO(member.read()), expected, fields)
+    except (FileNotFoundError, KeyError):
+        return fname, [("file", fname, None)]
+    except (OSError, zipfile.BadZipFile) as e:
+        return fname, [("file", fname, f"unreadable: {e}")]
+
+
+def audit_output(target, assignments, workers=1, fields=Config.AUDIT_FIELDS):
+    """Audits every assigned form in an output directory or ZIP, yielding (filename, problems).
+
+    `assignments` are the (filename, form data) pairs the output was
+    generated from; results come back in their order. Forms are read in a
+    process pool when `workers` > 1. An assigned form missing from the
+    output is reported as ("file", filename, None).
+    """
+    profiler = current_profiler()
+    tasks = [(target, fname, data, fields) for fname, data in assignments]
+    if workers <= 1 or len(tasks) < 2:
+        for task in tasks:
+            with profiler.stage("audit"):
+                result = _audit_member(task)
+            yield result
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(_audit_member, tasks, chunksize=max(1, len(tasks) // (workers * 4)))
+        for _ in tasks:
+            with profiler.stage("audit"):
+                result = next(results)
+            yield result
+
+
+# ==========================================
+# 18. PREVIEW
+# ==========================================
+def document_html(document_xml):
+    """Renders the body of a main document XML as plain HTML for on-screen previews.
+
+    Paragraph text and tables (with merged cells as col/rowspans, nested
+    tables inside their cells) are kept; styling, images, headers and
+    footers are not.
+    """
+    from lxml import etree
+
+    body = etree.fromstring(document_xml).find(_W + "body")
+    return "".join(_block_html(elem) for elem in body)
+
+
+def _block_html(elem):
+    if elem.tag == _W + "p":
+        return f"<p>{html.escape(_paragraph_text(elem)).replace(chr(10), '<br>')}</p>"
+    if elem.tag != _W + "tbl":
+        return ""
+
+    rows, above = [], {}
+    for tr in elem.iterchildren(_W + "tr"):
+        trPr = tr.find(_W + "trPr/" + _W + "gridBefore")
+        offset = int(trPr.get(_W + "val", 0)) if trPr is not None else 0
+        here, row = {}, []
+        for tc in tr.iterchildren(_W + "tc"):
+            span = int(_tc_prop(tc, "gridSpan", 1))
+            cell = above.get(offset) if _tc_prop(tc, "vMerge") == "continue" else None
+            if cell is not None:
+                cell["rowspan"] += 1
+            else:
+                cell = {"tc": tc, "colspan": span, "rowspan": 1}
+                row.append(cell)
+            here[offset] = cell
+            offset += span
+        above = here
+        rows.append(row)
+
+    out = ['<table style="border-collapse:collapse">']
+    for row in rows:
+        out.append("<tr>")
+        for cell in row:
+            content = "".join(_block_html(child) for child in cell["tc"])
+            out.append(f'<td colspan="{cell["colspan"]}" rowspan="{cell["rowspan"]}" '
+                       f'style="border:1px solid #999;padding:2px 6px">{content}</td>')
+        out.append("</tr>")
+    out.append("</table>")
+    return "".join(out)
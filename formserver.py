@@ -0,0 +1,386 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+from http import HTTPStatus
+from itertools import islice
+from urllib.parse import parse_qsl, urlsplit
+from formengine import (
+    ENGINES, Config, FormNumberStore, TemplateCache, combine_documents, detect_type, plan_forms, reproducible_seed,
+    stream_extract_details, template_cache,
+)
+from inspectionformgenerator import BatchManifest
+
+# ==========================================
+# 1. POOL WORKERS
+# ==========================================
+class _TemplateMissing(Exception):
+    """A pool process was sent a template digest it has not compiled."""
+
+
+def _render_batch(digest, engine, datas, combined=False, template_bytes=None):
+    """Renders a batch of form data in a pool process.
+
+    Each process keeps its own template cache, so a template is compiled
+    there once and stays warm for later requests. Batches carry only the
+    digest; without `template_bytes` a miss raises `_TemplateMissing`, and
+    the batch is sent again with the bytes.
+    """
+    if template_bytes is None:
+        template = template_cache.lookup((digest, engine))
+        if template is None:
+            raise _TemplateMissing(digest)
+    else:
+        template = template_cache.compiled(template_bytes, engine, digest)
+    if combined:
+        return [template.document_xml(data) for data in datas]
+    return [template.render(data) for data in datas]
+
+
+def _unknown_template(digest):
+    raise HTTPError(404, f"Template {digest} is not loaded; upload it again")
+
+# ==========================================
+# 2. HTTP PLUMBING
+# ==========================================
+class HTTPError(Exception):
+    """Ends a request with this status and a JSON error message."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Request:
+    def __init__(self, method, path, params, headers, body):
+        self.method = method
+        self.path = path
+        self.params = params   # query string, last value wins
+        self.headers = headers # lower-cased names
+        self.body = body
+
+
+async def read_request(reader, writer, max_body=Config.SERVER_MAX_UPLOAD):
+    """Reads one HTTP/1.1 request, or returns None if the client sent nothing."""
+    line = await reader.readline()
+    if not line.strip():
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line") from None
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+        if len(headers) > 100:
+            raise HTTPError(431, "Too many headers")
+
+    if "chunked" in headers.get("transfer-encoding", "").lower():
+        raise HTTPError(411, "Send the template with a Content-Length")
+    try:
+        length = int(headers.get("content-length") or 0)
+    except ValueError:
+        raise HTTPError(400, "Bad Content-Length") from None
+    if length > max_body:
+        raise HTTPError(413, f"Templates are limited to {max_body // (1024 * 1024)} MB")
+    if length and headers.get("expect", "").lower() == "100-continue":
+        writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+    body = await reader.readexactly(length) if length else b""
+
+    url = urlsplit(target)
+    return Request(method.upper(), url.path.rstrip("/") or "/", dict(parse_qsl(url.query)), headers, body)
+
+
+def response_head(status, headers):
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+
+async def send_json(writer, status, payload):
+    body = json.dumps(payload, indent=1).encode("utf-8")
+    writer.write(response_head(status, {"Content-Type": "application/json", "Content-Length": len(body)}) + body)
+    await writer.drain()
+
+
+async def send_chunk(writer, data):
+    if data:
+        writer.writelines([b"%x\r\n" % len(data), data, b"\r\n"])
+        await writer.drain()
+
+
+class _ChunkSink:
+    """Unseekable file that collects ZIP output until it is sent as a chunk."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+# ==========================================
+# 3. GENERATION SERVICE
+# ==========================================
+class FormServer:
+    """Local HTTP API over the same planning and rendering as the web app.
+
+    POST /templates     body: a .docx; compiles it and returns its hash and details
+    GET  /templates/ID  details of a loaded template
+    POST /forms         body: a .docx, or ?template=ID; streams a ZIP of the forms
+    GET  /health        pool size and requests in progress
+
+    /forms takes the manifest's columns as query parameters (type, year or
+    start/end, start_num, seed, combined, reproducible and detail overrides), plus `name`
+    to detect the type from a filename and, with a number store, `key` to
+    keep a retried request's numbers. Requests are handled on one event
+    loop: compiling, extraction and number reservation run in threads, and
+    rendering in a pool of `workers` processes shared by every request,
+    each keeping at most two batches per worker in flight. Every form goes
+    out as a chunk once rendered, so the ZIP streams as it is produced.
+    Compiled templates stay in the process-wide template cache between
+    requests.
+    """
+
+    def __init__(self, workers=1, engine="splice", numbers=None, reproducible=False):
+        self.workers = max(1, workers)
+        self.engine = engine
+        self.numbers = numbers           # FormNumberStore shared with other frontends, or None to count from start_num
+        self.reproducible = reproducible # default for requests without a reproducible parameter
+        self.pool = None
+        self.active = 0
+
+    async def serve(self, host="127.0.0.1", port=Config.SERVER_PORT):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers)
+        # Start the pool processes before any helper thread exists
+        await asyncio.wrap_future(self.pool.submit(int))
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving inspection forms on http://{host}:{port} with {self.workers} workers", flush=True)
+        try:
+            # A service manager stops the server with SIGTERM; the pool still shuts down cleanly
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, server.close)
+        except NotImplementedError: # Windows
+            pass
+        try:
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+
+    async def handle(self, reader, writer):
+        started = time.perf_counter()
+        request, status, forms = None, 500, 0
+        self.active += 1
+        try:
+            request = await read_request(reader, writer)
+            if request is None:
+                return
+            status, forms = await self.dispatch(request, writer)
+        except HTTPError as e:
+            status = e.status
+            await send_json(writer, status, {"error": str(e)})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            status = 499 # client went away
+        except Exception as e:
+            print(f"!! {type(e).__name__}: {e}", flush=True)
+            if not writer.is_closing(): # nothing sent yet
+                await send_json(writer, 500, {"error": str(e)})
+        finally:
+            self.active -= 1
+            writer.close()
+            if request is not None:
+                print(f"{request.method} {request.path} {status} {forms} forms "
+                      f"{time.perf_counter() - started:.2f}s", flush=True)
+
+    async def dispatch(self, request, writer):
+        """Serves the request and returns (status, forms sent)."""
+        method, path = request.method, request.path
+        if path == "/health":
+            await send_json(writer, 200, {"status": "ok", "workers": self.workers, "active": self.active,
+                                          "cached_bytes": template_cache.total_bytes})
+            return 200, 0
+        if path == "/forms" and method == "POST":
+            return await self.generate(request, writer)
+        if path == "/templates" and method == "POST" or path.startswith("/templates/") and method == "GET":
+            if method == "GET":
+                request.params["template"] = path.rsplit("/", 1)[1]
+            digest, _, details = await self.load_template(request)
+            await send_json(writer, 200, {"template": digest, "details": details})
+            return 200, 0
+        if path in ("/health", "/forms", "/templates") or path.startswith("/templates/"):
+            raise HTTPError(405, f"{method} is not allowed on {path}")
+        raise HTTPError(404, f"No such endpoint {path}")
+
+    def _compile(self, template_bytes, digest=None):
+        digest = digest or TemplateCache.digest(template_bytes)
+        template = template_cache.compiled(template_bytes, self.engine, digest)
+        details = template_cache.get((digest, "details"), lambda: stream_extract_details(template_bytes))
+        return digest, template, details
+
+    async def load_template(self, request):
+        """Returns (hash, compiled template, details) of the uploaded or named template."""
+        if request.body:
+            try:
+                return await asyncio.to_thread(self._compile, request.body)
+            except Exception as e:
+                raise HTTPError(400, f"Could not read the template. {e}") from None
+        digest = request.params.get("template")
+        if not digest:
+            raise HTTPError(400, "Upload a .docx template or give ?template=ID")
+        template = template_cache.get((digest, self.engine), lambda: _unknown_template(digest))
+        return await asyncio.to_thread(self._compile, template.template_bytes, digest)
+
+    async def plan(self, request, details):
+        """Returns (type, combined, assignments) for the request's parameters."""
+        params = {k: v for k, v in request.params.items() if k not in ("template", "fields", "out_dir", "key")}
+        name = params.pop("name", "")
+        try:
+            job = BatchManifest.parse_row(dict(params, template=name or "upload"), "")
+        except KeyError as e:
+            raise HTTPError(400, f"Missing parameter {e}; give year, or start and end") from None
+        except ValueError as e:
+            raise HTTPError(400, str(e)) from None
+        req_type = job["type"] or detect_type(name)
+        if req_type not in Config.VALID_INSP_TYPES:
+            raise HTTPError(400, f"Give a type, or a name containing one of {Config.VALID_INSP_TYPES}")
+
+        form_data = {field: value or "Unknown" for field, value in details.items()}
+        form_data.update(job["fields"])
+        seed = job["seed"]
+        if seed is None and (job["reproducible"] or self.reproducible):
+            seed = reproducible_seed(form_data.get("project_no", ""), req_type, job["start"], job["end"])
+        numbers = self.numbers.reserver(request.params.get("key"), job["start_num"]) if self.numbers else None
+        try:
+            assignments = await asyncio.to_thread(plan_forms, form_data, job["start"], job["end"], req_type,
+                                                  job["start_num"], seed, numbers)
+        except ValueError as e:
+            raise HTTPError(400, f"Could not plan the forms. {e}") from None
+        return req_type, job["combined"], assignments
+
+    async def _render_in_pool(self, template, datas, combined):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.pool, _render_batch, template.digest, self.engine, datas, combined)
+        except _TemplateMissing:
+            # That process has not compiled this template yet; only then are its bytes shipped
+            return await loop.run_in_executor(self.pool, _render_batch, template.digest, self.engine, datas, combined,
+                                              template.template_bytes)
+
+    async def render(self, template, assignments, combined=False):
+        """Yields (filename, docx bytes or document XML) in order, rendered in the pool."""
+        source = iter(assignments)
+        pending = deque() # (names, future) in assignment order
+        try:
+            while True:
+                while len(pending) < self.workers * 2:
+                    batch = list(islice(source, Config.RENDER_BATCH))
+                    if not batch: break
+                    future = asyncio.ensure_future(self._render_in_pool(template, [data for _, data in batch], combined))
+                    pending.append(([fname for fname, _ in batch], future))
+                if not pending:
+                    break
+                names, future = pending.popleft()
+                for item in zip(names, await future):
+                    yield item
+        finally:
+            # A client that disconnects drops its queued batches
+            for _, future in pending:
+                future.cancel()
+
+    async def generate(self, request, writer):
+        _, template, details = await self.load_template(request)
+        req_type, combined, assignments = await self.plan(request, details)
+        if combined:
+            return await self._send_combined(writer, template, req_type, assignments)
+
+        writer.write(response_head(200, {
+            "Content-Type": "application/zip",
+            "Content-Disposition": f'attachment; filename="Inspection_Forms_{req_type}.zip"',
+            "Transfer-Encoding": "chunked",
+            "X-Form-Count": len(assignments),
+        }))
+        sink, sent = _ChunkSink(), 0
+        try:
+            async with aclosing(self.render(template, assignments)) as forms:
+                with zipfile.ZipFile(sink, "w") as zf:
+                    async for fname, content in forms:
+                        with zf.open(fname, "w") as entry:
+                            entry.write(content)
+                        sent += 1
+                        if len(sink.buffer) >= Config.SERVER_CHUNK_BYTES:
+                            await send_chunk(writer, sink.take())
+            await send_chunk(writer, sink.take())
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        except BaseException:
+            # Headers are out; an unterminated body tells the client the ZIP is incomplete
+            writer.transport.abort()
+            raise
+        return 200, sent
+
+    async def _send_combined(self, writer, template, req_type, assignments):
+        async with aclosing(self.render(template, assignments, combined=True)) as documents:
+            documents = [item async for item in documents]
+        output, count = await asyncio.to_thread(combine_documents, template, documents)
+        with output:
+            if not count:
+                raise HTTPError(400, "No forms fall in this period")
+            size = output.seek(0, os.SEEK_END)
+            output.seek(0)
+            writer.write(response_head(200, {
+                "Content-Type": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                "Content-Disposition": f'attachment; filename="Inspection_Forms_{req_type}.docx"',
+                "Content-Length": size,
+                "X-Form-Count": count,
+            }))
+            while chunk := output.read(Config.SERVER_CHUNK_BYTES):
+                writer.write(chunk)
+                await writer.drain()
+        return 200, count
+
+# ==========================================
+# ENTRY POINT
+# ==========================================
+if __name__ == "__main__":
+    multiprocessing.freeze_support() # Worker processes in the packaged EXE
+    parser = argparse.ArgumentParser(description="Inspection form generation HTTP API")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=Config.SERVER_PORT,
+                        help=f"Port to listen on (default: {Config.SERVER_PORT})")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Render forms in this many processes, shared by all requests (default: CPU count)")
+    parser.add_argument("--engine", choices=list(ENGINES), default="splice", help="Rendering engine (default: splice)")
+    parser.add_argument("--numbers", metavar="DB", nargs="?", const=Config.FORM_NUMBER_DB,
+                        help="Reserve form numbers from this shared SQLite sequence store "
+                             f"(default: {Config.FORM_NUMBER_DB})")
+    parser.add_argument("--reproducible", action="store_true",
+                        help="Derive dates from the project, type and period unless a request gives a seed, "
+                             "so identical requests get byte-identical responses")
+    args = parser.parse_args()
+    numbers = FormNumberStore(args.numbers) if args.numbers else None
+    try:
+        asyncio.run(FormServer(args.workers, args.engine, numbers, args.reproducible).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
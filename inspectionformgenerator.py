@@ -1,148 +1,64 @@
 import os
-import random
-import calendar
+import argparse
+import csv
+import hashlib
+import json
+import multiprocessing
 import shutil
-import tkinter as tk
-from tkinter import filedialog
-from datetime import date, timedelta
-from docx import Document
+import time
+import sys
+import zipfile
+from collections import OrderedDict
+from datetime import date
+from formengine import (
+    NULL_PROFILER, Config, FormArchive, FormNumberStore, OutputManifest, Profiler, compile_template, current_profiler,
+    MergeSource, audit_output, detect_type, plan_forms, plan_merge, profiling, reproducible_seed, stream_extract_details,
+    write_combined_incremental, write_forms_incremental,
+)
 
 # ==========================================
-# 1. CONFIGURATION
-# ==========================================
-class Config:
-    VALID_INSP_TYPES = ["RGI", "SAFE", "WSIN", "ENVI"]
-    
-    KEY_MAPPING = {
-        "PI Inspection Form": "location",
-        "Project No": "project_no",
-        "Inspector": "inspector",
-        "Contractor": "contractor",
-        "Form No": "form_no",
-        "Insp Type": "insp_type",
-        "Scheduled": "scheduled",
-        "Deadline": "deadline",
-        "Performed By": "inspector",   
-        "Checked By": "checker",
-        "Date": "perform_date",         
-    }
-
-# ==========================================
-# 2. DOCUMENT UTILITIES (Static Helpers)
-# ==========================================
-class DocUtils:
-    """Static helper methods for low-level Docx manipulation."""
-    
-    @staticmethod
-    def find_next_real_cell(row_cells, current_index):
-        """Skips merged cells to find the actual value cell."""
-        current_cell = row_cells[current_index]
-        next_index = current_index + 1
-        while next_index < len(row_cells):
-            next_cell = row_cells[next_index]
-            if next_cell._element is not current_cell._element:
-                return next_cell
-            next_index += 1
-        return None
-
-    @staticmethod
-    def safe_update_cell(cell, new_value):
-        """Updates cell text preserving format."""
-        if not cell: return
-        if cell.paragraphs:
-            p = cell.paragraphs[0]
-            if p.runs:
-                p.runs[0].text = str(new_value)
-                for run in p.runs[1:]:
-                    run.text = ""
-            else:
-                p.add_run(str(new_value))
-        else:
-            cell.text = str(new_value)
-
-# ==========================================
-# 3. DATE LOGIC
-# ==========================================
-class DateEngine:
-    """Handles calendar calculations."""
-    
-    @staticmethod
-    def get_random_weekday(year, month, start_day, end_day):
-        _, last_day_of_month = calendar.monthrange(year, month)
-        actual_start = max(1, start_day)
-        actual_end = min(end_day, last_day_of_month)
-        
-        if actual_start > actual_end:
-            return date(year, month, actual_end)
-
-        valid_dates = []
-        for day in range(actual_start, actual_end + 1):
-            try:
-                curr_date = date(year, month, day)
-                if curr_date.weekday() < 5: # Mon-Fri
-                    valid_dates.append(curr_date)
-            except ValueError:
-                continue
-                
-        if valid_dates:
-            return random.choice(valid_dates)
-        return date(year, month, actual_start)
-
-# ==========================================
-# 4. TEMPLATE MODEL
+# 1. TEMPLATE MODEL
 # ==========================================
 class InspectionTemplate:
     """Represents the uploaded Word document."""
     
-    def __init__(self, filepath):
+    def __init__(self, filepath, engine="splice", verbose=True):
         self.filepath = filepath
         self.filename = os.path.basename(filepath)
-        self.type = self._detect_type()
-        self.doc_obj = Document(filepath) # Keep a reference for scanning
-        self.project_details = self._extract_details()
-
-    def _detect_type(self):
-        fname_upper = self.filename.upper()
-        for type_code in Config.VALID_INSP_TYPES:
-            if type_code in fname_upper:
-                return type_code
-        return "UNKNOWN"
-
-    def _extract_details(self):
-        extracted = {
-            "location": "Unknown", "project_no": "Unknown",
-            "inspector": "Unknown", "contractor": "Unknown", "checker": "Unknown"
-        }
-        keys = {
-            "PI Inspection Form": "location", "Location": "location",           
-            "Project No": "project_no", "Inspector": "inspector",
-            "Contractor": "contractor", "Checked By": "checker"
-        }
-        
-        print("\n>> Scanning template for project details...")
-        for table in self.doc_obj.tables:
-            for row in table.rows:
-                cells = row.cells
-                for i, cell in enumerate(cells):
-                    cell_text = cell.text.strip()
-                    for key, field in keys.items():
-                        if key in cell_text:
-                            if key == "Inspector" and "PI Inspection" in cell_text: continue
-                            
-                            target = DocUtils.find_next_real_cell(cells, i)
-                            if target and target.text.strip():
-                                extracted[field] = target.text.strip()
-                                print(f"   Found {field.upper()}: {extracted[field]}")
+        self.verbose = verbose
+        self.type = self.detect_type(self.filename)
+        with current_profiler().stage("load_template"):
+            with open(filepath, "rb") as f:
+                template_bytes = f.read()
+        self.project_details = self._extract_details(template_bytes)
+        self.compiled = compile_template(template_bytes, engine) # Label -> cell slots
+
+    detect_type = staticmethod(detect_type)
+
+    def _extract_details(self, template_bytes):
+        if self.verbose: print("\n>> Scanning template for project details...")
+        with current_profiler().stage("extract"):
+            found = stream_extract_details(template_bytes)
+
+        extracted = {}
+        for field, value in found.items():
+            extracted[field] = value or "Unknown"
+            if value and self.verbose: print(f"   Found {field.upper()}: {value}")
         return extracted
 
 # ==========================================
-# 5. GENERATOR ENGINE
+# 2. GENERATOR ENGINE
 # ==========================================
 class FormGenerator:
     """Handles the creation of batch files."""
     
-    def __init__(self, template_model):
+    def __init__(self, template_model, workers=1, combined=False, numbers=None, archive=None, reproducible=False):
         self.template = template_model
+        self.workers = workers
+        self.combined = combined         # One multi-section .docx instead of a file per form
+        self.numbers = numbers           # FormNumberStore shared across runs, or None to count from start_num
+        self.archive = archive           # FormArchive receiving every form file, or None
+        self.reproducible = reproducible # Dates drawn from a seed derived from project, type and period
 
     def generate_batch(self, req_type, year):
         # Setup Output Directory
@@ -150,77 +66,590 @@ class FormGenerator:
         out_name = f"{req_type}_{year}_Forms_Generated"
         out_dir = os.path.join(downloads, out_name)
 
-        if os.path.exists(out_dir): shutil.rmtree(out_dir)
-        os.makedirs(out_dir)
-
         print(f"\n>> Generating {req_type} forms in: {out_dir}")
         
-        counter = 1
-        for month in range(1, 13):
-            # Calculate Dates
-            dates = self._calculate_dates_for_month(req_type, year, month)
-            
-            # Common Data
-            month_str = f"{month:02d}"
-            _, last_day = calendar.monthrange(year, month)
-            
-            base_data = self.template.project_details.copy()
-            base_data["scheduled"] = f"01/{month_str}/{year}"
-            base_data["deadline"] = f"{last_day}/{month_str}/{year}"
-            base_data["insp_type"] = req_type
-
-            # Generate Files
-            for perform_dt in dates:
-                date_str = perform_dt.strftime("%d/%m/%Y")
-                form_no = f"IPRJ{req_type}{counter:04d}"
-                
-                final_data = base_data.copy()
-                final_data["form_no"] = form_no
-                final_data["perform_date"] = date_str
+        manifest = OutputManifest(out_dir)
+        seed = self.schedule_seed(manifest, req_type, date(year, 1, 1), date(year, 12, 31))
 
-                self._create_single_file(final_data, out_dir, form_no)
-                print(f"Created: {form_no}.docx | {date_str}")
-                counter += 1
+        assignments = self.plan_range(req_type, date(year, 1, 1), date(year, 12, 31), seed=seed, key=out_dir)
+
+        # Generate Files
+        if self.combined:
+            fname = f"{req_type}_{year}_Forms.docx"
+            status = self.write_combined(out_dir, fname, assignments, manifest, seed)
+            print(f"{status.capitalize()}: {fname} | {len(assignments)} forms")
+        else:
+            for fname, data, status in self.write_forms(out_dir, assignments, manifest, seed):
+                print(f"{status.capitalize()}: {fname} | {data['perform_date']}")
 
         print(f"\nSUCCESS: Files saved to Downloads folder.")
         os.startfile(out_dir)
 
-    def _calculate_dates_for_month(self, req_type, year, month):
-        _, last_day = calendar.monthrange(year, month)
-        if req_type == "SAFE":
-            d1 = DateEngine.get_random_weekday(year, month, 1, 7)
-            min_gap = d1 + timedelta(days=14)
-            d2 = DateEngine.get_random_weekday(year, month, min_gap.day, last_day)
-            return [d1, d2]
+    def schedule_seed(self, manifest, req_type, start_date, end_date, overrides=None):
+        """Seed of the date draw for a batch written to the manifest's folder.
+
+        When reproducible it is derived from the project, type and period;
+        otherwise the previous run's seed is reused, so a rerun keeps its
+        dates and only changed forms are rewritten.
+        """
+        if self.reproducible:
+            project_no = {**self.template.project_details, **(overrides or {})}.get("project_no", "")
+            return reproducible_seed(project_no, req_type, start_date, end_date)
+        return OutputManifest.new_seed() if manifest.seed is None else manifest.seed
+
+    def plan_range(self, req_type, start_date, end_date, start_num=1, overrides=None, seed=None, key=None):
+        """Assigns every form's number, date and field values for the months in range.
+
+        With a number store, the numbers are reserved under `key` (the output folder),
+        so a rerun into the same folder keeps them.
+        """
+        form_data = {**self.template.project_details, **(overrides or {})}
+        numbers = self.numbers.reserver(os.path.abspath(key), start_num) if self.numbers and key else None
+        return plan_forms(form_data, start_date, end_date, req_type, start_num, seed, numbers)
+
+    def write_forms(self, out_dir, assignments, manifest=None, seed=None):
+        """Updates out_dir in place, yielding (filename, data, status) for each form.
+
+        Only forms whose fingerprint differs from the out_dir manifest are rendered.
+        With an archive, every rendered (new or updated) form is archived too;
+        unchanged forms were archived when they were written.
+        """
+        manifest = manifest or OutputManifest(out_dir)
+        if seed is not None: manifest.seed = seed
+        forms = write_forms_incremental(self.template.compiled, out_dir, assignments, self.workers, manifest)
+        if self.archive is None:
+            yield from forms
+            return
+        with self.archive.writer() as put:
+            for fname, data, status in forms:
+                if status != "unchanged":
+                    with open(os.path.join(out_dir, fname), "rb") as f:
+                        put(fname, data, f.read())
+                yield fname, data, status
+
+    def audit(self, out_dir, assignments, workers=None):
+        """Returns [(filename, problems)] for the forms in out_dir that do not match their assignments."""
+        workers = self.workers if workers is None else workers
+        return [(fname, problems) for fname, problems in audit_output(out_dir, assignments, workers) if problems]
+
+    @staticmethod
+    def describe_problem(fname, problem):
+        field, expected, found = problem
+        if field == "file":
+            return f"{fname}: {'missing' if found is None else found}"
+        if found is None:
+            return f"{fname}: no cell keeps {field} '{expected}' (label missing or overwritten by a later label)"
+        return f"{fname}: {field} expected '{expected}', found '{found}'"
+
+    def write_combined(self, out_dir, fname, assignments, manifest=None, seed=None):
+        """Writes every form as a section of out_dir/fname; returns "new", "updated" or "unchanged"."""
+        manifest = manifest or OutputManifest(out_dir)
+        if seed is not None: manifest.seed = seed
+        return write_combined_incremental(self.template.compiled, out_dir, fname, assignments, manifest)
+
+# ==========================================
+# 3. HEADLESS BATCH RUNNER
+# ==========================================
+class BatchManifest:
+    """Reads generation jobs from a CSV or JSON manifest.
+
+    Each job names a template and either a year or a start/end period
+    (YYYY-MM or YYYY-MM-DD). Optional columns: type, start_num, out_dir, seed, combined, reproducible and
+    any project detail field (location, project_no, ...) to override the
+    value extracted from the template.
+    """
+
+    DETAIL_FIELDS = ["location", "project_no", "inspector", "contractor", "checker"]
+
+    @staticmethod
+    def load(path):
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            if path.lower().endswith(".json"):
+                rows = json.load(f)
+                if isinstance(rows, dict): rows = rows.get("jobs", [])
+            else:
+                rows = list(csv.DictReader(f))
+
+        base_dir = os.path.dirname(os.path.abspath(path))
+        jobs = []
+        for n, row in enumerate(rows, start=1):
+            try:
+                jobs.append(BatchManifest.parse_row(row, base_dir))
+            except KeyError as e:
+                raise ValueError(f"Manifest row {n}: missing column {e}") from None
+            except ValueError as e:
+                raise ValueError(f"Manifest row {n}: {e}") from None
+        return jobs
+
+    @staticmethod
+    def parse_row(row, base_dir):
+        row = {k.strip().lower(): v for k, v in row.items() if k and v not in (None, "")}
+        template = os.path.join(base_dir, str(row["template"]))
+
+        req_type = str(row["type"]).upper() if "type" in row else None
+        if req_type and req_type not in Config.VALID_INSP_TYPES:
+            raise ValueError(f"type must be one of {Config.VALID_INSP_TYPES}")
+
+        if "year" in row:
+            year = int(row["year"])
+            start, end = date(year, 1, 1), date(year, 12, 31)
         else:
-            return [DateEngine.get_random_weekday(year, month, 1, last_day)]
+            start = BatchManifest._parse_date(str(row["start"]))
+            end = BatchManifest._parse_date(str(row.get("end", row["start"])))
+        if end < start:
+            raise ValueError("end is before start")
+
+        fields = dict(row.get("fields", {}))
+        fields.update({k: str(row[k]) for k in BatchManifest.DETAIL_FIELDS if k in row})
+        return {
+            "template": template, "type": req_type, "start": start, "end": end,
+            "start_num": int(row.get("start_num", 1)), "fields": fields,
+            "out_dir": row.get("out_dir"), "seed": int(row["seed"]) if "seed" in row else None,
+            "combined": str(row.get("combined", "")).strip().lower() in ("1", "true", "yes", "y"),
+            "reproducible": str(row.get("reproducible", "")).strip().lower() in ("1", "true", "yes", "y"),
+        }
+
+    @staticmethod
+    def _parse_date(text):
+        if len(text) == 7: # YYYY-MM
+            return date(int(text[:4]), int(text[5:7]), 1)
+        return date.fromisoformat(text)
+
+
+_template_cache = OrderedDict() # path -> (mtime, InspectionTemplate), least recently used first, per process
+
+
+def _load_cached_template(path):
+    path, mtime = os.path.abspath(path), os.path.getmtime(path)
+    cached = _template_cache.pop(path, None)
+    template = cached[1] if cached and cached[0] == mtime else InspectionTemplate(path, verbose=False)
+    _template_cache[path] = (mtime, template)
+    while len(_template_cache) > Config.MANIFEST_TEMPLATE_CACHE:
+        _template_cache.popitem(last=False)
+    return template
 
-    def _create_single_file(self, data, out_dir, fname):
-        # Open a fresh copy of the doc for every iteration
-        doc = Document(self.template.filepath)
-        
-        for table in doc.tables:
-            for row in table.rows:
-                cells = row.cells
-                for i, cell in enumerate(cells):
-                    text = cell.text.strip()
-                    for key, field in Config.KEY_MAPPING.items():
-                        if key in text:
-                            if key == "Inspector" and "PI Inspection" in text: continue
-                            target = DocUtils.find_next_real_cell(cells, i)
-                            if target:
-                                DocUtils.safe_update_cell(target, data[field])
-        
-        doc.save(os.path.join(out_dir, f"{fname}.docx"))
+
+def run_manifest_job(job, out_root, profile=False, numbers=None, archive=None, verify=False, workers=1):
+    """Runs one manifest job and returns its summary line data.
+
+    With `profile`, the job's stage timings are added as summary["profile"].
+    With a `numbers` store, form numbers come from its shared sequences, and
+    with an `archive` every form is archived. With `verify`, the written
+    forms are audited and any mismatches listed in summary["problems"].
+    The job renders and audits with `workers` processes of its own.
+    """
+    profiler = Profiler() if profile else NULL_PROFILER
+    with profiling(profiler):
+        summary = _run_manifest_job(job, out_root, numbers, archive, verify, workers)
+    if profile: summary["profile"] = profiler.report()
+    return summary
+
+
+def _run_manifest_job(job, out_root, numbers=None, archive=None, verify=False, workers=1):
+    started = time.perf_counter()
+    summary = {"template": os.path.basename(job["template"]), "type": job["type"] or "?",
+               "forms": 0, "unchanged": 0, "status": "OK", "out_dir": "", "problems": []}
+    try:
+        template = _load_cached_template(job["template"])
+        req_type = job["type"] or template.type
+        summary["type"] = req_type
+        if req_type == "UNKNOWN":
+            raise ValueError(f"Filename must contain {Config.VALID_INSP_TYPES} or set a type")
+        if template.type not in ("UNKNOWN", req_type):
+            raise ValueError(f"Template is {template.type}, job requests {req_type}")
+
+        start, end = job["start"], job["end"]
+        period = str(start.year) if (start.month, end.month, start.year) == (1, 12, end.year) \
+            else f"{start:%Y%m}-{end:%Y%m}"
+        stem = os.path.splitext(template.filename)[0]
+        out_dir = job["out_dir"] or os.path.join(out_root, stem, f"{req_type}_{period}_Forms_Generated")
+        summary["out_dir"] = out_dir
+
+        manifest = OutputManifest(out_dir)
+        generator = FormGenerator(template, workers, numbers=numbers, archive=archive, reproducible=job.get("reproducible"))
+        seed = job["seed"]
+        if seed is None:
+            seed = generator.schedule_seed(manifest, req_type, start, end, job["fields"])
+
+        assignments = generator.plan_range(req_type, start, end, job["start_num"], job["fields"], seed, out_dir)
+        if job.get("combined"):
+            status = generator.write_combined(out_dir, f"{req_type}_{period}_Forms.docx", assignments, manifest, seed)
+            summary["forms"] = len(assignments)
+            summary["unchanged"] = len(assignments) if status == "unchanged" else 0
+        else:
+            for _, _, status in generator.write_forms(out_dir, assignments, manifest, seed):
+                summary["forms"] += 1
+                summary["unchanged"] += status == "unchanged"
+            if verify:
+                failed = generator.audit(out_dir, assignments, workers)
+                summary["problems"] = [generator.describe_problem(f, p) for f, problems in failed for p in problems]
+                if failed: summary["status"] = f"AUDIT FAILED: {len(failed)} forms"
+    except Exception as e:
+        summary["status"] = f"FAILED: {e}"
+    summary["seconds"] = time.perf_counter() - started
+    return summary
+
+
+class BatchRunner:
+    """Runs every job of a manifest without any prompts or dialogs."""
+
+    def __init__(self, manifest_path, out_root, workers=1, combined=False, numbers=None, archive=None, verify=False,
+                 reproducible=False):
+        self.manifest_path = manifest_path
+        self.out_root = out_root
+        self.workers = workers
+        self.combined = combined         # default for jobs without a combined column
+        self.numbers = numbers
+        self.archive = archive
+        self.verify = verify             # audit every job's forms once written
+        self.reproducible = reproducible # default for jobs without a reproducible column
+
+    def run(self):
+        try:
+            jobs = BatchManifest.load(self.manifest_path)
+        except (OSError, ValueError) as e:
+            print(f">> [!] ERROR: {e}")
+            return 2
+
+        for job in jobs:
+            job["combined"] = job["combined"] or self.combined
+            job["reproducible"] = job["reproducible"] or self.reproducible
+
+        print(f">> Running {len(jobs)} jobs from {self.manifest_path} with {self.workers} worker(s)")
+        # Jobs sharing a template run next to each other so each process parses it once
+        order = sorted(range(len(jobs)), key=lambda n: jobs[n]["template"])
+        ordered_jobs = [jobs[n] for n in order]
+        # Jobs may run in other processes, so each profiles itself and reports back
+        profiler = current_profiler()
+        if self.workers > 1 and len(jobs) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            chunksize = max(1, len(jobs) // (self.workers * 4))
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = list(pool.map(run_manifest_job, ordered_jobs, [self.out_root] * len(jobs),
+                                        [profiler.enabled] * len(jobs), [self.numbers] * len(jobs),
+                                        [self.archive] * len(jobs), [self.verify] * len(jobs),
+                                        chunksize=chunksize))
+        else:
+            # Jobs run one at a time here, so each renders and audits with the worker processes itself
+            results = [run_manifest_job(job, self.out_root, profiler.enabled, self.numbers, self.archive,
+                                        self.verify, self.workers) for job in ordered_jobs]
+        for summary in results:
+            if "profile" in summary: profiler.merge(summary.pop("profile"))
+
+        summaries = [None] * len(jobs)
+        for n, summary in zip(order, results):
+            summaries[n] = summary
+        return self._print_summary(summaries)
+
+    @staticmethod
+    def _print_summary(summaries):
+        print("\n" + "="*50)
+        print("BATCH SUMMARY")
+        for n, s in enumerate(summaries, start=1):
+            print(f"{n:>4}. {s['template']} [{s['type']}] {s['forms']} forms "
+                  f"({s['unchanged']} unchanged) in {s['seconds']:.2f}s -> {s['status']}")
+            if s["status"] == "OK": print(f"      {s['out_dir']}")
+            for problem in s["problems"][:10]:
+                print(f"      ! {problem}")
+            if len(s["problems"]) > 10: print(f"      ! ... {len(s['problems']) - 10} more")
+        failed = sum(1 for s in summaries if s["status"] != "OK")
+        total = sum(s["forms"] for s in summaries)
+        print(f"\n>> {len(summaries) - failed} jobs OK, {failed} failed, {total} forms generated.")
+        return 1 if failed else 0
+
+
+class MergeRunner:
+    """Renders one form per row of a CSV/XLSX mail-merge file, streaming the rows."""
+
+    def __init__(self, template_path, data_path, out_root, workers=1, req_type=None,
+                 combined=False, sheet=None, start_num=1, numbers=None, archive=None, verify=False):
+        self.template_path = template_path
+        self.data_path = data_path
+        self.out_root = out_root
+        self.workers = workers
+        self.req_type = req_type
+        self.combined = combined
+        self.sheet = sheet
+        self.start_num = start_num
+        self.numbers = numbers
+        self.archive = archive
+        self.verify = verify
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            template = InspectionTemplate(self.template_path, verbose=False)
+            req_type = (self.req_type or template.type).upper()
+            if req_type not in Config.VALID_INSP_TYPES:
+                raise ValueError(f"Filename must contain {Config.VALID_INSP_TYPES} or pass --type")
+
+            data_stem = os.path.splitext(os.path.basename(self.data_path))[0]
+            out_dir = os.path.join(self.out_root, os.path.splitext(template.filename)[0],
+                                   f"{req_type}_{data_stem}_Merged")
+            print(f">> Merging rows of {self.data_path} into {out_dir}")
+
+            generator = FormGenerator(template, self.workers, archive=self.archive)
+            if self.combined:
+                fname = f"{req_type}_{data_stem}_Forms.docx"
+                status = generator.write_combined(out_dir, fname, self._plan(template, req_type, out_dir))
+                print(f"{status.capitalize()}: {fname}")
+            else:
+                counts = {"new": 0, "updated": 0, "unchanged": 0}
+                assignments = self._plan(template, req_type, out_dir)
+                for n, (_, _, status) in enumerate(generator.write_forms(out_dir, assignments), start=1):
+                    counts[status] += 1
+                    if n % 500 == 0: print(f"   ... {n} forms")
+                print(", ".join(f"{count} {status}" for status, count in counts.items()))
+                if self.verify:
+                    # The rows are read again; keyed number blocks make the plan come out the same
+                    failed = generator.audit(out_dir, self._plan(template, req_type, out_dir))
+                    for fname, problems in failed:
+                        for problem in problems: print(f"   ! {generator.describe_problem(fname, problem)}")
+                    print(f">> Audit: {len(failed)} forms with problems")
+                    if failed: return 1
+        except (OSError, ValueError, KeyError) as e:
+            print(f">> [!] ERROR: {e}")
+            return 1
+        print(f"\n>> Done in {time.perf_counter() - started:.2f}s")
+        return 0
+
+    def _plan(self, template, req_type, out_dir):
+        rows = MergeSource(self.data_path, sheet=self.sheet)
+        numbers = self.numbers.reserver(os.path.abspath(out_dir), self.start_num) if self.numbers else None
+        return plan_merge(rows, template.project_details, req_type, self.start_num, numbers)
+
+
+class AuditRunner:
+    """Audits an output folder or ZIP against the form data listed in a CSV/XLSX file.
+
+    The rows are read like mail-merge rows, so form numbers, dates and
+    derived scheduled/deadline values are expected exactly as a merge would write them.
+    """
+
+    def __init__(self, target, expected_path, workers=1, req_type=None, sheet=None, start_num=1):
+        self.target = target
+        self.expected_path = expected_path
+        self.workers = workers
+        self.req_type = (req_type or "").upper()
+        self.sheet = sheet
+        self.start_num = start_num
+
+    def run(self):
+        started = time.perf_counter()
+        try:
+            assignments = plan_merge(MergeSource(self.expected_path, sheet=self.sheet), {}, self.req_type, self.start_num)
+            checked, failed = 0, 0
+            for fname, problems in audit_output(self.target, assignments, self.workers):
+                checked += 1
+                failed += bool(problems)
+                for problem in problems: print(f"   ! {FormGenerator.describe_problem(fname, problem)}")
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f">> [!] ERROR: {e}")
+            return 2
+        seconds = time.perf_counter() - started
+        print(f"\n>> Audited {checked} forms in {seconds:.2f}s: {checked - failed} OK, {failed} with problems")
+        return 1 if failed else 0
+
+class ArchiveSearch:
+    """Lists archived forms matching a query and optionally rebuilds them into a ZIP."""
+
+    FILTERS = {"project": "project_no", "type": "insp_type", "form": "form_no", "start": "start", "end": "end"}
+
+    def __init__(self, archive, query, zip_path=None):
+        self.archive = archive
+        self.query = query
+        self.zip_path = zip_path
+
+    def run(self):
+        try:
+            filters = {}
+            for part in filter(None, (p.strip() for p in self.query.split(","))):
+                name, _, value = part.partition("=")
+                if name.strip().lower() not in self.FILTERS:
+                    raise ValueError(f"Unknown filter '{name}'. Use {', '.join(self.FILTERS)}")
+                key = self.FILTERS[name.strip().lower()]
+                filters[key] = date.fromisoformat(value.strip()) if key in ("start", "end") else value.strip()
+            if "insp_type" in filters: filters["insp_type"] = filters["insp_type"].upper()
+            rows = self.archive.find(**filters)
+        except ValueError as e:
+            print(f">> [!] ERROR: {e}")
+            return 2
+
+        for row in rows:
+            print(f"{row['form_no']:<20} {row['insp_type']:<5} {row['project_no']:<15} {row['perform_date']}")
+        print(f"\n>> {len(rows)} archived forms match.")
+        if self.zip_path and rows:
+            archive_zip, count = self.archive.build_zip(rows)
+            with archive_zip, open(self.zip_path, "wb") as f:
+                shutil.copyfileobj(archive_zip, f)
+            print(f">> Rebuilt {count} forms into {self.zip_path}")
+        return 0
+
+class FolderWatcher:
+    """Generates a year's batch for every template dropped into a folder, until interrupted.
+
+    The folder itself (not its subfolders, where output goes) is scanned
+    every `Config.WATCH_INTERVAL` seconds. A .docx is picked up once its
+    size and modification time have held for `Config.WATCH_SETTLE` seconds,
+    so files still being copied are left alone. Its type comes from the
+    filename, as for any template. A template whose content hash matches
+    the version last processed is skipped; hashes are kept in the folder's
+    .forms_watch.json, so a restart skips them too. Failed jobs are not
+    recorded there: their template is tried again once it changes or the
+    watcher restarts. Jobs run in a pool of
+    `workers` processes with at most two per worker queued, each writing
+    `<template>_<TYPE>_<year>_Forms` next to its template.
+    """
+
+    STATE_FILE = ".forms_watch.json"
+
+    def __init__(self, watch_dir, year, workers=1, combined=False, numbers=None, archive=None, verify=False,
+                 reproducible=False):
+        self.watch_dir = watch_dir
+        self.year = year
+        self.workers = max(1, workers)
+        self.combined = combined
+        self.numbers = numbers
+        self.archive = archive
+        self.verify = verify
+        self.reproducible = reproducible
+        self.state_path = os.path.join(watch_dir, self.STATE_FILE)
+        self.state = self._load_state() # filename -> {"stat": [size, mtime_ns], "sha256": hash} last processed
+        self.settling = {}              # filename -> (stat, first seen with that stat)
+        self.running = {}               # future -> (filename, stat, hash)
+        self.failed = {}                # filename -> stat whose job failed, retried once it changes
+
+    def _load_state(self):
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return dict(json.load(f))
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def _save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def _content_hash(path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _scan(self, now):
+        """Returns [(filename, stat)] of templates that changed since last processed and have settled."""
+        current = {}
+        with os.scandir(self.watch_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(".docx") and not entry.name.startswith("~$"):
+                    st = entry.stat()
+                    current[entry.name] = [st.st_size, st.st_mtime_ns]
+
+        ready = []
+        for name in self.settling.keys() - current.keys():
+            del self.settling[name]
+        for name, stat in current.items():
+            recorded = self.state.get(name)
+            if (recorded and recorded["stat"] == stat) or self.failed.get(name) == stat:
+                self.settling.pop(name, None)
+                continue
+            if self.settling.get(name, (None,))[0] != stat:
+                self.settling[name] = (stat, now)
+            elif now - self.settling[name][1] >= Config.WATCH_SETTLE:
+                ready.append((name, stat))
+        return ready
+
+    def _collect(self):
+        """Reports finished jobs and records the templates of successful ones as processed."""
+        for future in [f for f in self.running if f.done()]:
+            name, stat, content_hash = self.running.pop(future)
+            if future.cancelled():
+                continue # never ran; picked up again on the next start
+            try:
+                s = future.result()
+                print(f">> {name} [{s['type']}] {s['forms']} forms ({s['unchanged']} unchanged) "
+                      f"in {s['seconds']:.2f}s -> {s['status']}")
+                for problem in s["problems"][:10]:
+                    print(f"   ! {problem}")
+                ok = s["status"] == "OK"
+            except Exception as e:
+                print(f">> {name} -> FAILED: {e}")
+                ok = False
+            if not ok:
+                self.failed[name] = stat
+                continue
+            self.failed.pop(name, None)
+            self.state[name] = {"stat": stat, "sha256": content_hash}
+            self._save_state()
+
+    def poll(self, pool, now=None):
+        """One scan: records finished jobs, then queues settled templates while the pool has room."""
+        now = time.monotonic() if now is None else now
+        self._collect()
+        busy = {name for name, _, _ in self.running.values()}
+        for name, stat in self._scan(now):
+            if len(self.running) >= self.workers * 2:
+                break
+            if name in busy:
+                continue # picked up again once its current job is done
+            del self.settling[name]
+            path = os.path.join(self.watch_dir, name)
+            try:
+                content_hash = self._content_hash(path)
+            except OSError:
+                continue # removed or locked meanwhile; retried on the next scan
+            recorded = self.state.get(name)
+            req_type = InspectionTemplate.detect_type(name)
+            if (recorded and recorded["sha256"] == content_hash) or req_type == "UNKNOWN":
+                if req_type == "UNKNOWN":
+                    print(f">> {name}: skipped, filename must contain {Config.VALID_INSP_TYPES}")
+                self.state[name] = {"stat": stat, "sha256": content_hash}
+                self._save_state()
+                continue
+
+            stem = os.path.splitext(name)[0]
+            job = {
+                "template": path, "type": req_type, "start": date(self.year, 1, 1), "end": date(self.year, 12, 31),
+                "start_num": 1, "fields": {}, "seed": None, "combined": self.combined, "reproducible": self.reproducible,
+                "out_dir": os.path.join(self.watch_dir, f"{stem}_{req_type}_{self.year}_Forms"),
+            }
+            print(f">> Queued {name} [{req_type} {self.year}]")
+            future = pool.submit(run_manifest_job, job, self.watch_dir, False, self.numbers, self.archive, self.verify)
+            self.running[future] = (name, stat, content_hash)
+
+    def run(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        print(f">> Watching {self.watch_dir} for templates ({self.year} batches, "
+              f"{self.workers} worker(s)). Press Ctrl+C to stop.")
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            while True:
+                self.poll(pool)
+                time.sleep(Config.WATCH_INTERVAL)
+        except KeyboardInterrupt:
+            print("\n>> Stopping; letting running jobs finish...")
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self._collect()
+        return 0
 
 # ==========================================
-# 6. USER INTERFACE
+# 4. USER INTERFACE
 # ==========================================
 class UserInterface:
     """Handles inputs, outputs, and dialogs."""
     
     @staticmethod
     def open_file_dialog():
+        import tkinter as tk # GUI toolkit only loads for interactive runs
+        from tkinter import filedialog
+
         root = tk.Tk()
         root.withdraw() 
         root.attributes('-topmost', True) 
@@ -272,14 +701,19 @@ class UserInterface:
         return input("Enter 1 or 2: ").strip()
 
 # ==========================================
-# 7. MAIN CONTROLLER
+# 5. MAIN CONTROLLER
 # ==========================================
 class Application:
     """Orchestrates the program flow."""
     
-    def __init__(self):
+    def __init__(self, workers=1, combined=False, numbers=None, archive=None, reproducible=False):
         self.ui = UserInterface()
         self.current_template = None
+        self.workers = workers
+        self.combined = combined
+        self.numbers = numbers
+        self.archive = archive
+        self.reproducible = reproducible
 
     def _acquire_template(self):
         """Loop until valid template is loaded."""
@@ -327,7 +761,8 @@ class Application:
                 break
 
             # 3. Generate
-            generator = FormGenerator(self.current_template)
+            generator = FormGenerator(self.current_template, self.workers, self.combined, self.numbers, self.archive,
+                                      self.reproducible)
             generator.generate_batch(req_type, year)
 
             # 4. Loop or Exit
@@ -341,5 +776,73 @@ class Application:
 # ENTRY POINT
 # ==========================================
 if __name__ == "__main__":
-    app = Application()
-    app.run()
\ No newline at end of file
+    multiprocessing.freeze_support() # Worker processes in the packaged EXE
+    parser = argparse.ArgumentParser(description="Universal Inspection Form Generator")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Render forms in this many parallel processes (default: 1)")
+    parser.add_argument("--manifest",
+                        help="Run the jobs in this CSV/JSON manifest without prompts")
+    parser.add_argument("--out", default=os.path.join(os.path.expanduser("~"), "Downloads"),
+                        help="Output root for manifest and merge jobs (default: ~/Downloads)")
+    parser.add_argument("--merge", metavar="ROWS",
+                        help="Render one form per row of this CSV/XLSX file (needs --template)")
+    parser.add_argument("--template", help="Template for --merge")
+    parser.add_argument("--type", help="Inspection type for --merge (default: from the template filename)")
+    parser.add_argument("--sheet", help="Worksheet of an XLSX --merge file (default: the first)")
+    parser.add_argument("--combined", action="store_true",
+                        help="Write each batch as one .docx with a section per form")
+    parser.add_argument("--reproducible", action="store_true",
+                        help="Derive each batch's dates from its project, type and period, so identical "
+                             "requests write byte-identical forms")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="Write per-stage timings and memory peaks to this JSON file")
+    parser.add_argument("--numbers", metavar="DB", nargs="?", const=Config.FORM_NUMBER_DB,
+                        help="Reserve form numbers from this shared SQLite sequence store "
+                             f"(default: {Config.FORM_NUMBER_DB}); reruns into a folder keep their numbers")
+    parser.add_argument("--archive", metavar="DIR", nargs="?", const=Config.ARCHIVE_DIR,
+                        help=f"Also store every form in this archive (default: {Config.ARCHIVE_DIR})")
+    parser.add_argument("--find", metavar="QUERY",
+                        help="Search the archive instead of generating: project=..., type=..., form=..., "
+                             "start=YYYY-MM-DD, end=YYYY-MM-DD (comma separated)")
+    parser.add_argument("--zip", metavar="PATH", help="With --find, rebuild the matching forms into this ZIP")
+    parser.add_argument("--verify", action="store_true",
+                        help="Audit the forms of --manifest and --merge runs once written")
+    parser.add_argument("--audit", metavar="PATH",
+                        help="Audit an output folder or ZIP against the form rows in --expected")
+    parser.add_argument("--expected", metavar="ROWS", help="CSV/XLSX of the form data --audit expects")
+    parser.add_argument("--watch", metavar="DIR",
+                        help="Keep generating a batch for each new or changed template dropped into this folder")
+    parser.add_argument("--year", type=int, default=date.today().year,
+                        help="Year of the batches --watch generates (default: this year)")
+    args = parser.parse_args()
+    numbers = FormNumberStore(args.numbers) if args.numbers else None
+    archive = FormArchive(args.archive) if args.archive else None
+
+    profiler = Profiler() if args.profile else NULL_PROFILER
+    try:
+        with profiling(profiler):
+            if args.watch:
+                sys.exit(FolderWatcher(args.watch, args.year, args.workers, args.combined, numbers, archive,
+                                       args.verify, args.reproducible).run())
+            if args.audit:
+                if not args.expected: parser.error("--audit needs --expected")
+                sys.exit(AuditRunner(args.audit, args.expected, args.workers, args.type, args.sheet).run())
+            if args.find is not None:
+                sys.exit(ArchiveSearch(archive or FormArchive(), args.find, args.zip).run())
+            if args.manifest:
+                sys.exit(BatchRunner(args.manifest, args.out, args.workers, args.combined, numbers, archive,
+                                     args.verify, args.reproducible).run())
+            if args.merge:
+                if not args.template: parser.error("--merge needs --template")
+                sys.exit(MergeRunner(args.template, args.merge, args.out, args.workers, args.type,
+                                     args.combined, args.sheet, numbers=numbers, archive=archive,
+                                     verify=args.verify).run())
+
+            app = Application(workers=args.workers, combined=args.combined, numbers=numbers, archive=archive,
+                              reproducible=args.reproducible)
+            app.run()
+    finally:
+        if args.profile:
+            with open(args.profile, "w", encoding="utf-8") as f:
+                json.dump(profiler.report(), f, indent=2)
+            print(f">> Profile written to {args.profile}")
\ No newline at end of file
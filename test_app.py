@@ -0,0 +1,150 @@
+import io
+import os
+import tempfile
+import time
+import unittest
+import zipfile
+from test_formengine import story_template
+
+try:
+    from streamlit.testing.v1 import AppTest
+except ImportError: # the web app's dependencies are optional for the engine tests
+    AppTest = None
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+
+
+def _app(app_path, uploads, merge_upload, data_dir, downloads):
+    """Runs app.py with the file uploaders answering `uploads` and `merge_upload`, and stores under data_dir.
+
+    Every download button's (label, data) is appended to `downloads`.
+    """
+    import functools
+    import io
+    import os
+    import runpy
+    import formengine
+    import streamlit as st
+
+    class Upload(io.BytesIO):
+        def __init__(self, name, content):
+            super().__init__(content)
+            self.name = name
+
+    def file_uploader(label, *args, accept_multiple_files=False, **kwargs):
+        if accept_multiple_files:
+            return [Upload(name, content) for name, content in uploads]
+        return merge_upload and Upload(*merge_upload)
+
+    def download_button(label, data, *args, **kwargs):
+        shown = download(label, data, *args, **kwargs) # rejects data Streamlit cannot serve
+        downloads.append((label, data))
+        return shown
+
+    download = st.download_button
+    patched = {
+        (st, "file_uploader"): file_uploader,
+        (st, "download_button"): download_button,
+        (formengine, "FormNumberStore"): functools.partial(formengine.FormNumberStore, os.path.join(data_dir, "numbers.sqlite3")),
+        (formengine, "FormArchive"): functools.partial(formengine.FormArchive, os.path.join(data_dir, "archive")),
+    }
+    originals = {target: getattr(*target) for target in patched}
+    for (owner, name), value in patched.items():
+        setattr(owner, name, value)
+    try:
+        runpy.run_path(app_path)
+    finally:
+        for (owner, name), value in originals.items():
+            setattr(owner, name, value)
+
+
+@unittest.skipIf(AppTest is None, "streamlit is not installed")
+class AppDownloadTest(unittest.TestCase):
+    """Clicks through the web app until its download buttons are shown."""
+
+    def setUp(self):
+        import streamlit as st
+
+        st.cache_resource.clear() # a job manager, number store and archive per test
+        self.data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.data_dir.cleanup)
+
+    def app(self, uploads, merge_upload=None):
+        self.downloaded = []
+        at = AppTest.from_function(_app, args=(APP_PATH, uploads, merge_upload, self.data_dir.name, self.downloaded),
+                                   default_timeout=30)
+        return at.run()
+
+    def click(self, at, label):
+        next(b for b in at.button if b.label.startswith(label)).click()
+        return at.run()
+
+    def finish_jobs(self, at):
+        """Reruns the app until no job is running, as its own polling would."""
+        deadline = time.monotonic() + 30
+        while not at.exception and any("(running)" in m.value or "(queued)" in m.value for m in at.markdown):
+            self.assertLess(time.monotonic(), deadline, "generation job did not finish")
+            at.run()
+        self.assertFalse(at.exception, [e.message for e in at.exception])
+        return at
+
+    def downloads(self, at):
+        """{label: data} of the download buttons shown by the last run."""
+        shown = {b.proto.label for b in at.get("download_button")}
+        return {label: data for label, data in self.downloaded if label in shown}
+
+    def test_single_template_zip_downloads(self):
+        at = self.app([("Site_SAFE.docx", story_template())])
+        at = self.click(at, "📋 Plan Forms")
+        at = self.finish_jobs(self.click(at, "🚀 Generate All"))
+        self.assertTrue(any("Success! Generated" in s.value for s in at.success))
+        data = self.downloads(at)["📥 Download ZIP File"]
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            self.assertTrue(zf.namelist())
+
+    def test_combined_document_downloads(self):
+        at = self.app([("Site_SAFE.docx", story_template())])
+        next(c for c in at.checkbox if c.label == "Combine into one document").check()
+        at = self.click(at.run(), "📋 Plan Forms")
+        at = self.finish_jobs(self.click(at, "🚀 Generate All"))
+        data = self.downloads(at)["📥 Download Combined Document"]
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIn("word/document.xml", zf.namelist())
+
+    def test_several_templates_zip_downloads(self):
+        at = self.app([("Site_SAFE.docx", story_template()), ("Site_RGI.docx", story_template())])
+        at = self.finish_jobs(self.click(at, "🚀 Generate All (2 templates)"))
+        data = self.downloads(at)["📥 Download ZIP File"]
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertEqual({name.split("/")[1] for name in zf.namelist()}, {"SAFE", "RGI"})
+
+    def test_archived_forms_download(self):
+        at = self.app([("Site_SAFE.docx", story_template())])
+        next(c for c in at.checkbox if c.label == "Archive generated forms").check()
+        at = self.click(at.run(), "📋 Plan Forms")
+        at = self.finish_jobs(self.click(at, "🚀 Generate All"))
+        generated = self.downloads(at)["📥 Download ZIP File"]
+
+        at.selectbox(key="archive_type").select("SAFE")
+        at = self.click(self.click(at.run(), "🔍 Search Archive"), "📦 Build ZIP from Archive")
+        self.assertFalse(at.exception, [e.message for e in at.exception])
+        data = next(data for label, data in self.downloads(at).items() if label.endswith("Archived Forms"))
+        with zipfile.ZipFile(io.BytesIO(data)) as archived, zipfile.ZipFile(io.BytesIO(generated)) as zf:
+            self.assertEqual(sorted(archived.namelist()), sorted(zf.namelist()))
+
+    def test_merge_streams_rows_past_the_preview(self):
+        rows = "Form No,Performed By,Perform Date\n" + "".join(f",Inspector {n},{n % 28 + 1:02d}/03/2025\n" for n in range(150))
+        at = self.app([("Site_SAFE.docx", story_template())], ("rows.csv", rows.encode("utf-8")))
+        at = self.click(at, "📋 Plan Forms")
+        preview = at.session_state["plan"]["forms"]
+        self.assertEqual(len(preview), 100)
+        at = self.finish_jobs(self.click(at, "🚀 Generate All"))
+        with zipfile.ZipFile(io.BytesIO(self.downloads(at)["📥 Download ZIP File"])) as zf:
+            names = zf.namelist()
+        self.assertEqual(len(names), 150)
+        self.assertEqual(names[:100], [fname for fname, _ in preview]) # the reviewed numbers are the ones generated
+
+
+if __name__ == "__main__":
+    unittest.main()
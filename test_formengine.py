@@ -0,0 +1,460 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import zipfile
+from datetime import date, timedelta
+from docx import Document
+from docx.shared import Inches
+from lxml import etree
+from formengine import (
+    BusinessDayScheduler, Config, audit_form, audit_output, FormNumberStore, HKHolidays, JobManager, MergeSource, OutputManifest, compile_template, plan_forms,
+    plan_merge, scan_fill,
+    write_combined_incremental, write_forms_incremental, write_zip,
+)
+
+W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+LABELS = list(Config.KEY_MAPPING) + ["Location", "Remarks", "Item"]
+
+FORMS = [
+    {"form_no": "IPRJSAFE0001", "perform_date": "07/01/2025", "scheduled": "01/01/2025", "deadline": "31/01/2025",
+     "inspector": "Carol", "checker": "Dan", "contractor": "NewCo", "location": "Site Q", "project_no": "P-1",
+     "insp_type": "SAFE"},
+    # Values that are labels themselves trip the guards and take the scan-fill path
+    {"form_no": "Date", "perform_date": "Inspector", "inspector": "Checked By", "checker": "Form No",
+     "project_no": "Deadline", "insp_type": "RGI"},
+    # Escaping, whitespace, tabs and line breaks
+    {"form_no": "A&B <1>", "inspector": "  padded  ", "location": "Line 1\nLine 2\tTabbed", "project_no": '"q"'},
+]
+
+
+def _saved(doc):
+    stream = io.BytesIO()
+    doc.save(stream)
+    return stream.getvalue()
+
+
+def synthetic_template(seed):
+    """Tables of random labels and values with random horizontal and vertical merges."""
+    rng = random.Random(seed)
+    doc = Document()
+    for _ in range(3):
+        rows, cols = 12, rng.randint(2, 5)
+        table = doc.add_table(rows=rows, cols=cols)
+        for r in range(rows):
+            for c in range(cols):
+                if rng.random() < 0.4:
+                    table.cell(r, c).text = rng.choice(LABELS) + (" x" if rng.random() < 0.3 else "")
+                elif rng.random() < 0.3:
+                    table.cell(r, c).text = f"val{rng.randint(0, 99)}"
+        for _ in range(rows // 2):
+            r, c = rng.randrange(rows), rng.randrange(cols)
+            try:
+                if rng.random() < 0.5 and c + 1 < cols:
+                    table.cell(r, c).merge(table.cell(r, min(cols - 1, c + rng.randint(1, 2))))
+                elif r + 1 < rows:
+                    table.cell(r, c).merge(table.cell(min(rows - 1, r + rng.randint(1, 3)), c))
+            except Exception:
+                pass # merges that would cut across earlier ones
+    return _saved(doc)
+
+
+def guard_template():
+    """Labels sitting right of labels, so filled values are scanned again."""
+    doc = Document()
+    table = doc.add_table(rows=4, cols=4)
+    for r, row in enumerate([["Form No", "Date", "Inspector", ""],
+                             ["Project No", "Checked By", "", "Deadline"],
+                             ["Scheduled", "", "Performed By", "Insp Type"],
+                             ["Contractor", "PI Inspection Form", "Date", ""]]):
+        for c, text in enumerate(row):
+            table.cell(r, c).text = text
+    table.cell(2, 1).merge(table.cell(3, 1))
+    return _saved(doc)
+
+
+def audit_template():
+    """One label per row, with its value cell to the right."""
+    doc = Document()
+    table = doc.add_table(rows=5, cols=2)
+    for r, label in enumerate(["Form No", "Date", "Scheduled", "Deadline", "Project No"]):
+        table.cell(r, 0).text = label
+    return _saved(doc)
+
+
+def story_template():
+    """Labels in a nested table, a text box, the header and the footer."""
+    doc = Document()
+    table = doc.add_table(rows=2, cols=2)
+    table.cell(0, 0).text = "Form No"
+    table.cell(1, 0).text = "Project No"
+    inner = table.cell(1, 1).add_table(rows=1, cols=2)
+    inner.cell(0, 0).text = "Inspector"
+    inner.cell(0, 1).text = "Alice"
+    header = doc.sections[0].header.add_table(rows=1, cols=2, width=Inches(4))
+    header.cell(0, 0).text = "Contractor"
+    footer = doc.sections[0].footer.add_table(rows=1, cols=2, width=Inches(4))
+    footer.cell(0, 0).text = "Checked By"
+
+    boxed = doc.add_table(rows=1, cols=2)
+    boxed.cell(0, 0).text = "Insp Type"
+    tbl = boxed._tbl
+    tbl.getparent().remove(tbl)
+    run = etree.SubElement(doc.add_paragraph()._p, f"{{{W}}}r")
+    shape = etree.SubElement(etree.SubElement(run, f"{{{W}}}pict"), "{urn:schemas-microsoft-com:vml}shape")
+    content = etree.SubElement(etree.SubElement(shape, "{urn:schemas-microsoft-com:vml}textbox"), f"{{{W}}}txbxContent")
+    content.append(tbl)
+    etree.SubElement(content, f"{{{W}}}p")
+    return _saved(doc)
+
+
+def _baseline_next_real_cell(row_cells, current_index):
+    current_cell = row_cells[current_index]
+    next_index = current_index + 1
+    while next_index < len(row_cells):
+        next_cell = row_cells[next_index]
+        if next_cell._element is not current_cell._element:
+            return next_cell
+        next_index += 1
+    return None
+
+
+def _baseline_update_cell(cell, new_value):
+    if not cell: return
+    if cell.paragraphs:
+        p = cell.paragraphs[0]
+        if p.runs:
+            p.runs[0].text = str(new_value)
+            for run in p.runs[1:]:
+                run.text = ""
+        else:
+            p.add_run(str(new_value))
+    else:
+        cell.text = str(new_value)
+
+
+def baseline_fill(doc, data):
+    """The original app's fill loop and helpers, kept verbatim as the golden reference for top-level tables."""
+    for table in doc.tables:
+        for row in table.rows:
+            cells = row.cells
+            for i, cell in enumerate(cells):
+                text = cell.text.strip()
+                for key, field in Config.KEY_MAPPING.items():
+                    if key in text:
+                        if key == "Inspector" and "PI Inspection" in text: continue
+                        target = _baseline_next_real_cell(cells, i)
+                        if target:
+                            _baseline_update_cell(target, data.get(field, ""))
+    return doc
+
+
+def package_parts(package):
+    """Every member of a .docx package, by name."""
+    with zipfile.ZipFile(io.BytesIO(package)) as zf:
+        return {name: zf.read(name) for name in zf.namelist()}
+
+
+def _reserve_blocks(path, count, size):
+    """Reserves `count` blocks from a fresh store on `path` (run in another process)."""
+    store = FormNumberStore(path)
+    return [store.reserve("SAFE", "P-1", size) for _ in range(count)]
+
+
+def story_xml(package):
+    """The XML of every word/*.xml part, by member name."""
+    with zipfile.ZipFile(io.BytesIO(package)) as zf:
+        return {name: zf.read(name) for name in zf.namelist() if name.startswith("word/") and name.endswith(".xml")}
+
+
+class EngineEquivalenceTest(unittest.TestCase):
+    """Both engines must write exactly what the reference scan fill writes."""
+
+    TEMPLATES = {
+        **{f"synthetic{seed}": synthetic_template(seed) for seed in range(4)},
+        "guards": guard_template(),
+        "stories": story_template(),
+    }
+
+    def test_compiled_fill_matches_scan_fill(self):
+        for name, template_bytes in self.TEMPLATES.items():
+            template = compile_template(template_bytes, "docx")
+            for n, data in enumerate(FORMS):
+                with self.subTest(template=name, form=n):
+                    expected = story_xml(_saved(scan_fill(Document(io.BytesIO(template_bytes)), data)))
+                    self.assertEqual(story_xml(template.render(data)), expected)
+
+    def test_splice_matches_python_docx(self):
+        for name, template_bytes in self.TEMPLATES.items():
+            reference = compile_template(template_bytes, "docx")
+            splice = compile_template(template_bytes, "splice")
+            for n, data in enumerate(FORMS):
+                with self.subTest(template=name, form=n):
+                    self.assertEqual(story_xml(splice.render(data)), story_xml(reference.render(data)))
+                    self.assertEqual(splice.document_xml(data), reference.document_xml(data))
+
+    def test_splice_rejects_what_python_docx_rejects(self):
+        # A character XML cannot hold sends the splice engine to the reference path, which raises
+        splice = compile_template(self.TEMPLATES["stories"], "splice")
+        with self.assertRaises(ValueError):
+            splice.render({"form_no": "bad\x01char"})
+
+
+class BaselineGoldenTest(unittest.TestCase):
+    """Rendered packages must match what the original app wrote, byte for byte."""
+
+    def test_engines_reproduce_baseline_packages(self):
+        # Merged cells in top-level tables, the only stories the original app filled
+        templates = {name: template_bytes for name, template_bytes in EngineEquivalenceTest.TEMPLATES.items()
+                     if name != "stories"}
+        for name, template_bytes in templates.items():
+            for engine in ("docx", "splice"):
+                template = compile_template(template_bytes, engine)
+                for n, data in enumerate(FORMS):
+                    with self.subTest(template=name, engine=engine, form=n):
+                        expected = package_parts(_saved(baseline_fill(Document(io.BytesIO(template_bytes)), data)))
+                        self.assertEqual(package_parts(template.render(data)), expected)
+
+    def test_story_values(self):
+        # Beyond the original app: nested tables, header, footer and text boxes are filled too
+        for engine in ("docx", "splice"):
+            with self.subTest(engine=engine):
+                doc = Document(io.BytesIO(compile_template(story_template(), engine).render(FORMS[0])))
+                table = doc.tables[0]
+                self.assertEqual(table.cell(0, 1).text, "IPRJSAFE0001")
+                self.assertEqual(table.cell(1, 1).paragraphs[0].text, "P-1")
+                self.assertEqual(table.cell(1, 1).tables[0].cell(0, 1).text, "Carol")
+                self.assertEqual(doc.sections[0].header.tables[0].cell(0, 1).text, "NewCo")
+                self.assertEqual(doc.sections[0].footer.tables[0].cell(0, 1).text, "Dan")
+                boxed = doc.element.body.find(f".//{{{W}}}txbxContent")
+                self.assertEqual("".join(t.text or "" for t in boxed.iter(f"{{{W}}}t")), "Insp TypeSAFE")
+
+
+class BusinessDaySchedulerTest(unittest.TestCase):
+    START, END = date(2024, 1, 1), date(2026, 12, 31)
+
+    def test_dates_are_business_days_in_their_month(self):
+        scheduler = BusinessDayScheduler(self.START, self.END, seed=7)
+        drawn = scheduler.draw(["RGI", "SAFE"])
+        for req_type in ("RGI", "SAFE"):
+            for year, month, dates in scheduler.month_dates(req_type, drawn[req_type]):
+                with self.subTest(req_type=req_type, month=f"{year}-{month:02d}"):
+                    self.assertEqual(len(dates), 2 if req_type == "SAFE" else 1)
+                    for d in dates:
+                        self.assertEqual((d.year, d.month), (year, month))
+                        self.assertLess(d.weekday(), 5)
+                        self.assertFalse(HKHolidays.is_holiday(d))
+
+    def test_safe_forms_are_spaced(self):
+        scheduler = BusinessDayScheduler(self.START, self.END, seed=3)
+        for year, month, (first, second) in scheduler.month_dates("SAFE", scheduler.draw(["SAFE"])["SAFE"]):
+            with self.subTest(month=f"{year}-{month:02d}"):
+                self.assertLessEqual(first.day, 7)
+                self.assertGreaterEqual(second - first, timedelta(days=14))
+
+    def test_holidays_are_skipped(self):
+        # Every weekday of March 2025 but the 12th is a holiday
+        march = [date(2025, 3, day) for day in range(1, 32)]
+        holidays = {d for d in march if d.day != 12}
+        for seed in range(20):
+            scheduler = BusinessDayScheduler(date(2025, 3, 1), date(2025, 3, 31), holidays=holidays, seed=seed)
+            self.assertEqual(list(scheduler.month_dates("RGI", scheduler.draw(["RGI"])["RGI"]))[0][2], [date(2025, 3, 12)])
+
+    def test_seed_repeats_the_schedule(self):
+        draw = lambda seed: list(BusinessDayScheduler(self.START, self.END, seed=seed).draw(["SAFE"])["SAFE"])
+        self.assertEqual(draw(11), draw(11))
+        self.assertNotEqual(draw(11), draw(12))
+
+
+class MergeSourceTest(unittest.TestCase):
+    def test_csv_rows(self):
+        csv_bytes = ("\ufeffProject No,Performed By,perform_date,Notes\n"
+                     "P-1,Alice,07/03/2025,ignored\n"
+                     ",,,\n"
+                     "P-2,,2025-03-09,\n").encode("utf-8")
+        rows = list(MergeSource(io.BytesIO(csv_bytes), "rows.csv"))
+        self.assertEqual(rows, [{"project_no": "P-1", "inspector": "Alice", "perform_date": "07/03/2025"},
+                                {"project_no": "P-2", "perform_date": "2025-03-09"}])
+
+    def test_header_without_fields(self):
+        with self.assertRaises(ValueError):
+            list(MergeSource(io.BytesIO(b"a,b\n1,2\n"), "rows.csv"))
+
+    def test_xlsx_rows(self):
+        try:
+            from openpyxl import Workbook
+        except ImportError:
+            self.skipTest("openpyxl is not installed")
+        workbook = Workbook()
+        workbook.active.title = "Other"
+        workbook.active.append(["Form No"])
+        workbook.active.append(["WRONG"])
+        sheet = workbook.create_sheet("Rows")
+        sheet.append(["Form No", None, "Date", "Checked By"])
+        sheet.append(["F-1", "skipped", date(2025, 3, 7), "Dan"])
+        sheet["B3"], sheet["D3"] = "skipped", "Erin"
+        stream = io.BytesIO()
+        workbook.save(stream)
+        stream.seek(0)
+
+        rows = list(MergeSource(stream, "rows.xlsx", sheet="Rows"))
+        self.assertEqual(rows[1], {"checker": "Erin"})
+        self.assertEqual(rows[0]["form_no"], "F-1")
+        self.assertEqual(rows[0]["checker"], "Dan")
+        planned = list(plan_merge(rows[:1], {}, "RGI"))
+        self.assertEqual(planned[0][1]["perform_date"], "07/03/2025")
+
+    def test_plan_merge(self):
+        rows = [{"perform_date": "07/02/2025"}, {"form_no": "F-9", "deadline": "2025-03-20"}]
+        planned = list(plan_merge(rows, {"project_no": "P-1"}, "SAFE", start_num=5))
+        self.assertEqual([fname for fname, _ in planned], ["IPRJSAFE0005.docx", "F-9.docx"])
+        self.assertEqual((planned[0][1]["scheduled"], planned[0][1]["deadline"]), ("01/02/2025", "28/02/2025"))
+        self.assertEqual(planned[1][1]["deadline"], "20/03/2025")
+        self.assertEqual(planned[1][1]["project_no"], "P-1")
+
+    def test_plan_merge_rejects_bad_rows(self):
+        for rows in ([{"form_no": "../escaped"}], [{"form_no": "sub/x"}], [{"form_no": "A"}, {"form_no": "A"}],
+                     [{"perform_date": "someday"}]):
+            with self.subTest(rows=rows), self.assertRaisesRegex(ValueError, "Merge row"):
+                list(plan_merge(rows, {}, "RGI"))
+
+
+class FormNumberStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "numbers.sqlite3")
+        self.addCleanup(shutil.rmtree, os.path.dirname(self.path))
+
+    def test_concurrent_blocks_never_overlap(self):
+        from concurrent.futures import ProcessPoolExecutor
+
+        FormNumberStore(self.path) # create the schema before the race
+        with ProcessPoolExecutor(max_workers=4) as pool:
+            firsts = [first for block in pool.map(_reserve_blocks, [self.path] * 4, [25] * 4, [10] * 4) for first in block]
+        numbers = [n for first in firsts for n in range(first, first + 10)]
+        self.assertEqual(sorted(numbers), list(range(1, 1001)))
+
+    def test_keyed_reservation_repeats(self):
+        store = FormNumberStore(self.path)
+        first = store.reserve("RGI", "P-1", 12, key="out/a")
+        self.assertEqual(store.reserve("RGI", "P-1", 12, key="out/a"), first)
+        self.assertEqual(store.reserve("RGI", "P-1", 12), first + 12)
+        self.assertEqual(store.reserve("RGI", "P-2", 5), 1) # sequences are per type and project
+
+    def test_start_moves_the_sequence_forward(self):
+        store = FormNumberStore(self.path)
+        self.assertEqual(store.reserve("WSIN", "P-1", 10, start=100), 100)
+        self.assertEqual(store.reserve("WSIN", "P-1", 10, start=1), 110)
+
+    def test_reserver_keys_each_block(self):
+        store = FormNumberStore(self.path)
+        planned = lambda: [fname for fname, _ in plan_forms({"project_no": "P-1"}, date(2025, 1, 1), date(2025, 6, 30),
+                                                            "SAFE", seed=1, numbers=store.reserver("k"))]
+        self.assertEqual(planned(), planned())
+        self.assertEqual(planned()[0], "IPRJSAFE0001.docx")
+
+
+class AuditTest(unittest.TestCase):
+    def setUp(self):
+        self.template = compile_template(audit_template())
+        self.planned = plan_forms({"project_no": "P-1"}, date(2025, 1, 1), date(2025, 4, 30), "RGI", seed=2)
+
+    def test_correct_form_passes(self):
+        fname, data = self.planned[0]
+        self.assertEqual(audit_form(io.BytesIO(self.template.render(data)), data), [])
+
+    def test_wrong_date_is_reported(self):
+        fname, data = self.planned[0]
+        expected = dict(data, perform_date="01/01/1999")
+        self.assertEqual(audit_form(io.BytesIO(self.template.render(data)), expected),
+                         [("perform_date", "01/01/1999", data["perform_date"])])
+
+    def test_missing_label_is_reported(self):
+        data = dict(self.planned[0][1])
+        problems = audit_form(io.BytesIO(compile_template(story_template()).render(data)), data)
+        self.assertIn(("perform_date", data["perform_date"], None), problems)
+
+    def test_output_directory_and_zip(self):
+        with tempfile.TemporaryDirectory() as out_dir:
+            list(write_forms_incremental(self.template, out_dir, self.planned))
+            os.remove(os.path.join(out_dir, self.planned[1][0]))
+            tampered = [(self.planned[2][0], dict(self.planned[2][1], deadline="31/12/1999"))]
+            assignments = self.planned[:2] + tampered + self.planned[3:]
+            archive, _ = write_zip((fname, self.template.render(data)) for fname, data in self.planned[:1])
+            zip_path = os.path.join(out_dir, "forms.zip")
+            with archive, open(zip_path, "wb") as f:
+                shutil.copyfileobj(archive, f)
+
+            for workers in (1, 2):
+                with self.subTest(workers=workers):
+                    failed = {fname: problems for fname, problems in audit_output(out_dir, assignments, workers) if problems}
+                    self.assertEqual(failed, {
+                        self.planned[1][0]: [("file", self.planned[1][0], None)],
+                        self.planned[2][0]: [("deadline", "31/12/1999", self.planned[2][1]["deadline"])],
+                    })
+                    zipped = dict(audit_output(zip_path, self.planned[:2], workers))
+                    self.assertEqual(zipped, {self.planned[0][0]: [], self.planned[1][0]: [("file", self.planned[1][0], None)]})
+
+
+class JobManagerTest(unittest.TestCase):
+    def test_finished_job_keeps_bytes_until_discarded(self):
+        manager = JobManager(max_jobs=1)
+        job = manager.submit("test", "forms.zip", lambda job: [("a.docx", b"a"), ("b.docx", b"b")], build=write_zip)
+        manager._pool.shutdown(wait=True)
+        self.assertEqual(job.status, "done")
+        content, count = job.result
+        self.assertEqual(count, 2)
+        with zipfile.ZipFile(io.BytesIO(content)) as zf:
+            self.assertEqual(zf.namelist(), ["a.docx", "b.docx"])
+        manager.discard(job.id)
+        self.assertIsNone(job.result)
+        self.assertIsNone(manager.get(job.id))
+
+
+class IncrementalOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.template = compile_template(story_template())
+        self.out_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.out_dir)
+
+    def write(self, assignments):
+        return {fname: status for fname, _, status in write_forms_incremental(self.template, self.out_dir, assignments)}
+
+    def test_rerun_leaves_unchanged_forms_alone(self):
+        planned = plan_forms(FORMS[0], date(2025, 1, 1), date(2025, 3, 31), "SAFE", seed=5)
+        self.assertEqual(set(self.write(planned).values()), {"new"})
+        mtimes = {fname: os.stat(os.path.join(self.out_dir, fname)).st_mtime_ns for fname, _ in planned}
+
+        self.assertEqual(set(self.write(planned).values()), {"unchanged"})
+        self.assertEqual(mtimes, {fname: os.stat(os.path.join(self.out_dir, fname)).st_mtime_ns for fname, _ in planned})
+        self.assertEqual(set(OutputManifest(self.out_dir).forms), {fname for fname, _ in planned})
+
+    def test_changed_and_dropped_forms(self):
+        planned = plan_forms(FORMS[0], date(2025, 1, 1), date(2025, 3, 31), "SAFE", seed=5)
+        self.write(planned)
+        changed = [(planned[0][0], dict(planned[0][1], inspector="Eve"))] + planned[1:-1]
+        statuses = self.write(changed)
+        self.assertEqual(statuses[planned[0][0]], "updated")
+        self.assertEqual(set(statuses.values()), {"updated", "unchanged"})
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, planned[-1][0])))
+        self.assertNotIn(planned[-1][0], OutputManifest(self.out_dir).forms)
+
+
+class StaleCleanupTest(unittest.TestCase):
+    def test_combined_output_keeps_files_outside_out_dir(self):
+        with tempfile.TemporaryDirectory() as root:
+            out_dir = os.path.join(root, "out")
+            outside = os.path.join(root, "outside.docx")
+            with open(outside, "wb") as f:
+                f.write(b"keep")
+            manifest = OutputManifest(out_dir)
+            manifest.forms = {"../outside.docx": "tampered"}
+            template = compile_template(story_template())
+            status = write_combined_incremental(template, out_dir, "all.docx", [("a.docx", FORMS[0])], manifest)
+            self.assertEqual(status, "new")
+            self.assertTrue(os.path.exists(outside))
+
+
+if __name__ == "__main__":
+    unittest.main()